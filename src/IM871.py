@@ -3,13 +3,44 @@
 from flags import Flags
 from array import array
 from enum import Enum
-import os
+from util import HexDump
+from SMI260Metrics import counter
+import logging
+
+logger = logging.getLogger(__name__)
+
+PACKETS = counter('im871_packets_total', 'Packets decoded from the data of the stick')
+CRC_ERRORS = counter('im871_crc_errors_total', 'Packets dropped because their CRC does not match')
+RESYNCS = counter('im871_resyncs_total', 'Searches for the next Start Of Frame')
+DISCARDED_BYTES = counter('im871_discarded_bytes_total', 'Bytes skipped while searching for a packet')
 
 SOF = 0xA5
+HEADER_LENGTH = 4
+MAX_BUFFER_SIZE = 4096
+CRC16_POLY = 0x8408  # 0x8408 is deduced from the polynomial X**16 + X**12 + X**5 + X**0
+
+
+def build_crc16_table():
+    """ Returns the 256 CRC16 remainders used for bytewise processing
+    """
+    table = []
+    for index in range(256):
+        crc = index
+        for x in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ CRC16_POLY
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = build_crc16_table()
 
 
 # Endpoint Identifier
 class EndpointID(Enum):
+    UNKNOWN_ID = 0x00
     DEVMGMT_ID = 0x01
     RADIOLINK_ID = 0x02
     RADIOLINKTEST_ID = 0x03
@@ -17,6 +48,7 @@ class EndpointID(Enum):
 
 
 class DeviceMessageIdentifier(Enum):
+    DEVMGMT_MSG_UNKNOWN = 0x00
     DEVMGMT_MSG_PING_REQ = 0x01
     DEVMGMT_MSG_PING_RSP = 0x02
     DEVMGMT_MSG_SET_CONFIG_REQ = 0x03
@@ -53,6 +85,7 @@ class DeviceMessageIdentifier(Enum):
 
 
 class RadioLinkMessageIdentifier(Enum):
+    RADIOLINK_MSG_UNKNOWN = 0x00
     RADIOLINK_MSG_WMBUSMSG_REQ = 0x01
     RADIOLINK_MSG_WMBUSMSG_RSP = 0x02
     RADIOLINK_MSG_WMBUSMSG_IND = 0x03
@@ -60,6 +93,21 @@ class RadioLinkMessageIdentifier(Enum):
     RADIOLINK_MSG_DATA_RSP = 0x05
 
 
+class RadioLinkTestMessageIdentifier(Enum):
+    RADIOLINKTEST_MSG_UNKNOWN = 0x00
+    RADIOLINKTEST_MSG_START_REQ = 0x01
+    RADIOLINKTEST_MSG_START_RSP = 0x02
+    RADIOLINKTEST_MSG_STATUS_IND = 0x07
+    RADIOLINKTEST_MSG_STOP_REQ = 0x08
+    RADIOLINKTEST_MSG_STOP_RSP = 0x09
+
+
+class HWTestMessageIdentifier(Enum):
+    HWTEST_MSG_UNKNOWN = 0x00
+    HWTEST_MSG_RADIOTEST_REQ = 0x01
+    HWTEST_MSG_RADIOTEST_RSP = 0x02
+
+
 class ControlFieldFlags(Flags):
     Reserved = 1
     TimeStampField = 2
@@ -67,20 +115,73 @@ class ControlFieldFlags(Flags):
     CRC16Field = 8
 
 
+MESSAGE_IDENTIFIERS = {
+    EndpointID.DEVMGMT_ID: DeviceMessageIdentifier,
+    EndpointID.RADIOLINK_ID: RadioLinkMessageIdentifier,
+    EndpointID.RADIOLINKTEST_ID: RadioLinkTestMessageIdentifier,
+    EndpointID.HWTEST_ID: HWTestMessageIdentifier,
+}
+
+
+def build_message_table(identifiers):
+    """ Returns the 256 message ids of an endpoint indexed by message id byte
+
+    Message ids not defined by identifiers map to its UNKNOWN member.
+    """
+    unknown = identifiers(0x00)
+    table = [unknown] * 256
+    for message_id in identifiers:
+        table[message_id.value] = message_id
+    return tuple(table)
+
+
+def build_header_table():
+    """ Returns the decoded headers indexed by control/endpoint byte
+
+    Every entry is a tuple (control_field, endpoint_id, trailer_length,
+    has_timestamp, has_rssi, has_crc, message_table). The trailer length
+    counts the optional bytes following the payload. Unknown endpoints
+    decode to EndpointID.UNKNOWN_ID and have no message table.
+    """
+    message_tables = {endpoint_id: build_message_table(identifiers)
+                      for endpoint_id, identifiers in MESSAGE_IDENTIFIERS.items()}
+    table = []
+    for byte in range(256):
+        control_field = ControlFieldFlags(byte >> 4)
+        has_timestamp = bool(control_field & ControlFieldFlags.TimeStampField)
+        has_rssi = bool(control_field & ControlFieldFlags.RSSIField)
+        has_crc = bool(control_field & ControlFieldFlags.CRC16Field)
+        trailer_length = 4 * has_timestamp + has_rssi + 2 * has_crc
+        try:
+            endpoint_id = EndpointID(byte & 0x0F)
+        except ValueError:
+            endpoint_id = EndpointID.UNKNOWN_ID
+        table.append((control_field, endpoint_id, trailer_length, has_timestamp, has_rssi, has_crc,
+                      message_tables.get(endpoint_id)))
+    return tuple(table)
+
+
+HEADER_TABLE = build_header_table()
+
+
 class Packet:
+    __slots__ = ('control_field', 'endpoint_id', 'message_id', 'payload_length', 'payload', 'timestamp', 'rssi',
+                 'wmbus_message', 'raw')
+
     def __init__(self):
         self.control_field = ControlFieldFlags.no_flags
         self.endpoint_id = EndpointID.DEVMGMT_ID
         self.message_id = None
         self.payload_length = 0
-        self.payload = bytearray()
+        self.payload = b''
         self.timestamp = 0
         self.rssi = 0
+        # length byte followed by the payload, set by IM871.decode
+        self.wmbus_message = None
+        # complete packet including header and CRC, only set by framers with keep_raw
+        self.raw = None
 
 class IM871:
-    def __init__(self):
-        self.debug = os.getenv('DEBUG', False)
-
     def build(self, packet):
         data = bytearray()
         data.append(SOF)
@@ -89,88 +190,117 @@ class IM871:
         data.append(len(packet.payload) & 0xff)
         data.extend(packet.payload)
 
+        if bool(packet.control_field & ControlFieldFlags.TimeStampField):
+            data.extend(packet.timestamp.to_bytes(4, byteorder='little'))
+
+        if bool(packet.control_field & ControlFieldFlags.RSSIField):
+            data.append(packet.rssi)
+
         if bool(packet.control_field & ControlFieldFlags.CRC16Field):
             crc = self.crc16(data[1:])
             data.append(crc & 0xff)
             data.append(crc >> 8 & 0xff)
 
-        # TODO: TIMESTAMP & RSSI
-
         return data
 
     def parse(self, data):
-        packets = []
-        offset = 0
+        """ Parses all complete packets contained in data
 
-        while offset < len(data):
-            packet = Packet()
+        Incomplete or corrupted bytes are skipped. Use IM871Framer to parse
+        a continuous stream where packets may span several reads.
+        """
+        return IM871Framer(self).feed(data)
 
-            if data[offset] != SOF:
-                print("WARINING! no Start Of Frame found!")
-                continue
+    def packet_length(self, data, offset):
+        """ Returns the total length of the packet starting at offset
 
-            packet.control_field = ControlFieldFlags(data[ offset + 1] >> 4)
-            packet.endpoint_id = EndpointID(data[offset + 1] & 0x0F)
-            if self.debug:
-                print("Control fields: " + str(packet.control_field))
-                print("Endpoint id: " + str(packet.endpoint_id))
-
-            if packet.endpoint_id == EndpointID.DEVMGMT_ID:
-                packet.message_id = DeviceMessageIdentifier(data[offset + 2])
-            elif packet.endpoint_id == EndpointID.RADIOLINK_ID:
-                packet.message_id = RadioLinkMessageIdentifier(data[offset + 2])
-
-            if self.debug:
-                print("Message id: " + str(packet.message_id))
-
-            packet.payload_length = data[offset + 3]
-            if self.debug:
-                print("Payload length: " + str(packet.payload_length))
-
-            if packet.payload_length != 0:
-                packet.payload = bytearray(data[offset + 4: offset + 4 + packet.payload_length])
-                if self.debug:
-                    print("Payload: " + self.to_hex(packet.payload))
-
-            length = packet.payload_length
-        
-            if bool(ControlFieldFlags.TimeStampField & packet.control_field):
-                length += 4
-                packet.timestamp = int.from_bytes(data[offset + length: offset + 4 + length], byteorder='little')
-
-            if bool(ControlFieldFlags.RSSIField & packet.control_field):
-                length += 1
-                packet.rssi = data[offset + 4 + length]
-
-            if bool(ControlFieldFlags.CRC16Field & packet.control_field):
-                packetdata = data[offset + 1:offset + 4+length]
-                crc = self.crc16(packetdata)
-                crcb = data[offset + 4+length:offset + 4+length+2]
-                crci = int.from_bytes(crcb, byteorder='little')
-                if crc != crci:
-                    print("WARNING! CRC does not match!")
-                    continue
-                length += 2
-            packets.append(packet)
-            offset += length + 4
+        The length includes the 4 byte header and the optional timestamp,
+        RSSI and CRC fields announced by the control field. None is returned
+        if the header can not belong to a valid packet.
+        """
+        header = data[offset + 1]
+        if header & 0x10 or HEADER_TABLE[header][6] is None:  # reserved bit or unknown endpoint
+            return None
 
-        return packets
+        return HEADER_LENGTH + data[offset + 3] + HEADER_TABLE[header][2]
+
+    def decode(self, data, offset):
+        """ Decodes the complete packet starting at offset
+
+        If data is a memoryview the payload of the packet refers to it without
+        copying. Unknown endpoints and message ids decode to their UNKNOWN
+        members. Returns None if the CRC does not match.
+        """
+        packet = Packet()
+
+        control_field, endpoint_id, trailer_length, has_timestamp, has_rssi, has_crc, messages = \
+            HEADER_TABLE[data[offset + 1]]
+        packet.control_field = control_field
+        packet.endpoint_id = endpoint_id
+        if messages is not None:
+            packet.message_id = messages[data[offset + 2]]
+
+        packet.payload_length = data[offset + 3]
+
+        position = offset + HEADER_LENGTH
+        if packet.payload_length != 0:
+            packet.payload = data[position: position + packet.payload_length]
+        position += packet.payload_length
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("control fields %s, endpoint id %s, message id %s, payload length %d, payload %s",
+                         packet.control_field, packet.endpoint_id, packet.message_id, packet.payload_length,
+                         HexDump(packet.payload))
+
+        # the length byte directly precedes the payload and doubles as wM-Bus length field
+        packet.wmbus_message = data[offset + 3:position]
+
+        if has_timestamp:
+            packet.timestamp = int.from_bytes(data[position: position + 4], byteorder='little')
+            position += 4
+
+        if has_rssi:
+            packet.rssi = data[position]
+            position += 1
+
+        if has_crc:
+            crc = self.crc16(data[offset + 1:position])
+            crci = int.from_bytes(data[position:position + 2], byteorder='little')
+            if crc != crci:
+                logger.warning("CRC does not match")
+                CRC_ERRORS.inc()
+                return None
+
+        return packet
 
     def get_wmbus_message(self, packet):
-        arr = [packet.payload_length]
+        if packet.wmbus_message is not None:
+            return packet.wmbus_message
+
+        arr = bytearray([len(packet.payload)])
         arr.extend(packet.payload)
-        return bytearray(arr)
+        return arr
 
     def crc16(self, packetdata):
-        POLY = 0x8408  # 0x8408 is deduced from the polynomial X**16 + X**12 + X**5 + X**0
+        """ Returns the CRC16 of packetdata using the precomputed CRC16_TABLE
+        """
+        table = CRC16_TABLE
+        crc = 0xFFFF  # init FCS to all ones
+        for byte in packetdata:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
 
+        return crc ^ 0xFFFF  # finally invert crc
+
+    def crc16_bitwise(self, packetdata):
+        """ Reference implementation of crc16 processing every single bit
+        """
         # process each byte
         crc = 0xFFFF  # init FCS to all ones
         for byte in packetdata:
             # process each bit of the current byte
             for x in range(8):
                 if (byte & 1) ^ (crc & 1):
-                    crc = (crc >> 1) ^ POLY
+                    crc = (crc >> 1) ^ CRC16_POLY
                 else:
                     crc >>= 1
                 byte >>= 1
@@ -178,13 +308,29 @@ class IM871:
 
         return crc
 
+    def verify_crcs(self, packets):
+        """ Verifies the CRC of many raw packets in one call
+
+        Each packet has to start with the Start Of Frame and end with the two
+        CRC bytes. Returns a list of booleans in the order of packets.
+        """
+        table = CRC16_TABLE
+        results = []
+        for packet in packets:
+            crc = 0xFFFF
+            for byte in memoryview(packet)[1:-2]:
+                crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+            results.append(crc ^ 0xFFFF == packet[-2] | packet[-1] << 8)
+
+        return results
+
     def to_hex(self, v, split=' '):
         """ Return value in hex form as a string (for pretty printing purposes).
         The function provides a conversion of integers or byte arrays ('B') into
         their hexadecimal form separated by the splitter string
         """
         myformat = "%0.2X"
-        if type(v) == array or type(v) == bytearray:
+        if type(v) in (array, bytearray, bytes, memoryview):
             return split.join(myformat % x for x in v)
         elif type(v) == str:
             temp = bytearray(v)
@@ -193,3 +339,88 @@ class IM871:
             return myformat % v
         else:
             return "tohex(): unsupported type"
+
+
+class IM871Framer:
+    """ Splits the continuous byte stream of the stick into packets
+
+    The framer owns a receive buffer which accumulates the chunks handed to
+    feed(), so packets spanning several reads are reassembled. Garbage,
+    unknown headers and CRC errors are skipped by scanning for the next Start
+    Of Frame. The buffer never grows beyond max_buffer_size bytes, headers
+    announcing a longer packet are skipped like garbage.
+
+    Returned packets refer to the received bytes through memoryview slices,
+    so the payloads are never copied. With keep_raw the packets also refer
+    to their complete bytes.
+    """
+
+    def __init__(self, stick=None, max_buffer_size=MAX_BUFFER_SIZE, keep_raw=False):
+        self.stick = stick if stick is not None else IM871()
+        self.max_buffer_size = max_buffer_size
+        self.keep_raw = keep_raw
+        self.buffer = b''
+        self.discarded = 0
+
+    def feed(self, data):
+        """ Adds data to the receive buffer and returns the completed packets
+        """
+        if self.buffer:
+            data = self.buffer + data
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        view = memoryview(data)
+        packets = []
+        offset = 0
+
+        while offset < len(data):
+            if data[offset] != SOF:
+                offset = self.resync(data, offset)
+                continue
+
+            if len(data) - offset < HEADER_LENGTH:
+                break
+
+            length = self.stick.packet_length(data, offset)
+            if length is None:
+                offset = self.resync(data, offset + 1)
+                continue
+
+            if len(data) - offset < length:
+                if length > self.max_buffer_size:
+                    offset = self.resync(data, offset + 1)
+                    continue
+                break
+
+            packet = self.stick.decode(view, offset)
+            if packet is None:
+                offset = self.resync(data, offset + 1)
+                continue
+
+            if self.keep_raw:
+                packet.raw = view[offset:offset + length]
+            packets.append(packet)
+            offset += length
+
+        # what is left is an incomplete packet of at most max_buffer_size bytes
+        self.buffer = data[offset:]
+        PACKETS.inc(len(packets))
+
+        return packets
+
+    def resync(self, data, offset):
+        """ Returns the offset of the next Start Of Frame after offset
+        """
+        found = data.find(SOF, offset)
+        if found < 0:
+            found = len(data)
+        if found != offset:
+            logger.warning("no Start Of Frame found, skipping %d bytes", found - offset)
+            self.discarded += found - offset
+            DISCARDED_BYTES.inc(found - offset)
+        RESYNCS.inc()
+        return found
+
+    def reset(self):
+        self.buffer = b''
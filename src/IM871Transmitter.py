@@ -0,0 +1,100 @@
+import asyncio
+import itertools
+import math
+import time
+from IM871 import EndpointID, RadioLinkMessageIdentifier, HEADER_LENGTH
+
+PRIORITY_COMMAND = 0
+PRIORITY_REFRESH = 1
+PRIORITY_POLL = 2
+
+
+class IM871Transmitter:
+    """ Single outbound queue of all messages written to the stick
+
+    Messages are written in order of their priority and, within the same
+    priority, in the order they were sent. Radio messages are paced by a
+    token bucket holding the airtime the duty cycle grants: it refills with
+    duty_cycle seconds per second and holds at most duty_cycle * window
+    seconds. Messages to the stick itself need no airtime. A message waiting
+    for airtime goes back into the queue, so a more urgent message sent
+    meanwhile is written first. Writing pauses while the transport signals
+    backpressure. No message is ever dropped.
+    """
+
+    PREAMBLE_LENGTH = 6  # preamble and sync word in bytes
+    ENCODING_FACTOR = 1.5  # 3 out of 6 encoding of T-mode
+
+    def __init__(self, duty_cycle=0.01, window=3600, chip_rate=100000):
+        self.duty_cycle = duty_cycle
+        self.capacity = duty_cycle * window
+        self.chip_rate = chip_rate
+        self.tokens = self.capacity
+        self.refilled = time.monotonic()
+        self.transport = None
+        self.queue = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.queued = asyncio.Event()
+        self.airtime_used = 0
+
+    def send(self, message, priority=PRIORITY_POLL):
+        """ Queues message and returns a future which is done once it is written
+        """
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((priority, next(self.counter), message, future))
+        self.queued.set()
+        return future
+
+    def airtime(self, message):
+        """ Returns the seconds a message sent by the stick occupies the radio
+        """
+        if message[1] & 0x0F != EndpointID.RADIOLINK_ID.value or \
+                message[2] != RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ.value:
+            return 0
+
+        # length field, payload and a CRC for the first 10 and every further 16 bytes
+        length = 1 + message[HEADER_LENGTH - 1]
+        length += 2 * (1 + math.ceil(max(length - 10, 0) / 16))
+        return (self.PREAMBLE_LENGTH + length * self.ENCODING_FACTOR) * 8 / self.chip_rate
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.refilled) * self.duty_cycle, self.capacity)
+        self.refilled = now
+
+    async def run(self):
+        while True:
+            await self.writable.wait()
+            entry = await self.queue.get()
+            priority, counter, message, future = entry
+            if not self.writable.is_set():
+                # paused while waiting for the message
+                self.queue.put_nowait(entry)
+                continue
+
+            airtime = self.airtime(message)
+            self.refill()
+            # a message longer than the bucket waits for a full one
+            needed = min(airtime, self.capacity)
+            if self.tokens < needed:
+                self.queue.put_nowait(entry)
+                self.queued.clear()
+                try:
+                    await asyncio.wait_for(self.queued.wait(), (needed - self.tokens) / self.duty_cycle)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.tokens -= airtime
+            self.airtime_used += airtime
+
+            self.transport.write(message)
+            if not future.done():
+                future.set_result(time.monotonic())
+
+    def pause(self):
+        self.writable.clear()
+
+    def resume(self):
+        self.writable.set()
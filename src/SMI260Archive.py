@@ -0,0 +1,251 @@
+import argparse
+import csv
+import datetime
+import heapq
+import json
+import logging
+import mmap
+import struct
+import sys
+from array import array
+from IM871 import IM871, IM871Framer, EndpointID, RadioLinkMessageIdentifier
+from SMI260Capture import CaptureReader, RECEIVED
+from SMI260Commands import SMI260Commands, FIELDS, decode_reading
+from wmbus import WMBusFrame, WMBusLayoutCache
+from util import HexDump
+
+logger = logging.getLogger('SMI260Archive')
+
+MAGIC = b'SMIARC1\n'
+HEADER = struct.Struct('<IQQQ')  # index_every, number of frames, offset of the time index, offset of the address index
+FRAME = struct.Struct('<QH')  # timestamp in microseconds since the epoch, length of the IM871 packet
+ENTRY = struct.Struct('<QQ')  # timestamp in microseconds since the epoch, offset of the frame
+ADDRESS = struct.Struct('<3sI')  # address field of the wM-Bus frame, number of entries
+FRAMES_OFFSET = len(MAGIC) + HEADER.size
+
+WMBUS_MESSAGES = (RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_IND,
+                  RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ)
+
+
+def build(path, captures, index_every=256):
+    """ Builds an archive of the wM-Bus packets received in capture files
+
+    The packets of all captures are stored in the order of their time as
+    the complete IM871 packets. Every index_every-th packet goes into the
+    sparse time index, every packet into the index of its address. Returns
+    the number of archived packets.
+    """
+    stick = IM871()
+    framers = [IM871Framer(stick, keep_raw=True) for _ in captures]
+    chunks = heapq.merge(*[received_chunks(number, capture) for number, capture in enumerate(captures)])
+
+    time_index = array('Q')
+    addresses = {}
+    count = 0
+    with open(path, 'wb') as archive:
+        archive.write(MAGIC)
+        archive.write(HEADER.pack(index_every, 0, 0, 0))
+        offset = FRAMES_OFFSET
+
+        for timestamp, number, data in chunks:
+            for packet in framers[number].feed(data):
+                if packet.endpoint_id != EndpointID.RADIOLINK_ID or packet.message_id not in WMBUS_MESSAGES:
+                    continue
+
+                microseconds = int(timestamp * 1e6)
+                if count % index_every == 0:
+                    time_index.extend((microseconds, offset))
+                message = stick.get_wmbus_message(packet)
+                if len(message) >= 10:
+                    addresses.setdefault(bytes(message[4:7]), array('Q')).extend((microseconds, offset))
+
+                archive.write(FRAME.pack(microseconds, len(packet.raw)))
+                archive.write(packet.raw)
+                offset += FRAME.size + len(packet.raw)
+                count += 1
+
+        time_index_offset = offset
+        archive.write(time_index.tobytes() if sys.byteorder == 'little' else _swapped(time_index))
+        address_index_offset = time_index_offset + len(time_index) * 8
+
+        archive.write(struct.pack('<I', len(addresses)))
+        for address, entries in sorted(addresses.items()):
+            archive.write(ADDRESS.pack(address, len(entries) // 2))
+            archive.write(entries.tobytes() if sys.byteorder == 'little' else _swapped(entries))
+
+        archive.seek(len(MAGIC))
+        archive.write(HEADER.pack(index_every, count, time_index_offset, address_index_offset))
+    return count
+
+
+def received_chunks(number, capture):
+    """ Yields the received chunks of a capture as tuples of timestamp, number and data
+    """
+    for timestamp, direction, data in CaptureReader(capture):
+        if direction == RECEIVED:
+            yield timestamp, number, data
+
+
+def _swapped(values):
+    values = array('Q', values)
+    values.byteswap()
+    return values.tobytes()
+
+
+class SMI260Archive:
+    """ Reads an archive built by build() through a memory map
+
+    Queries for a time range seek to the matching frames through the sparse
+    time index, queries for an address through the address index, so only
+    the matching frames are read and decoded. Frames which cannot be
+    decoded are skipped and counted in errors.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(path + " is not an archive")
+
+        self.index_every, self.count, self.time_index_offset, self.address_index_offset = \
+            HEADER.unpack_from(self.map, len(MAGIC))
+        self.time_entries = (self.address_index_offset - self.time_index_offset) // ENTRY.size
+
+        # address -> (offset of the first entry, number of entries)
+        self.addresses = {}
+        offset = self.address_index_offset
+        count, = struct.unpack_from('<I', self.map, offset)
+        offset += 4
+        for _ in range(count):
+            address, entries = ADDRESS.unpack_from(self.map, offset)
+            offset += ADDRESS.size
+            self.addresses[address] = (offset, entries)
+            offset += entries * ENTRY.size
+
+        self.stick = IM871()
+        self.layout_cache = WMBusLayoutCache()
+        self.errors = 0
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def bisect(self, offset, count, timestamp):
+        """ Returns the position of the first entry at or after timestamp
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if ENTRY.unpack_from(self.map, offset + middle * ENTRY.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def frames(self, start=None, end=None, address=None):
+        """ Yields the timestamp and the IM871 packet of the frames in a time range
+
+        start and end are in seconds since the epoch, address is the address
+        of an SMI260 like '7981'.
+        """
+        start = 0 if start is None else int(start * 1e6)
+        end = None if end is None else int(end * 1e6)
+
+        if address is not None:
+            offset, count = self.addresses.get(bytes(SMI260Commands.byte_from_address(address)), (0, 0))
+            for position in range(self.bisect(offset, count, start), count):
+                timestamp, frame = ENTRY.unpack_from(self.map, offset + position * ENTRY.size)
+                if end is not None and timestamp > end:
+                    return
+                yield self.frame(frame)
+            return
+
+        # the last indexed frame before start, all frames before it are older
+        position = self.bisect(self.time_index_offset, self.time_entries, start)
+        offset = FRAMES_OFFSET
+        if position > 0:
+            offset = ENTRY.unpack_from(self.map, self.time_index_offset + (position - 1) * ENTRY.size)[1]
+
+        while offset < self.time_index_offset:
+            timestamp, length = FRAME.unpack_from(self.map, offset)
+            if end is not None and timestamp > end:
+                return
+            if timestamp >= start:
+                yield self.frame(offset)
+            offset += FRAME.size + length
+
+    def frame(self, offset):
+        timestamp, length = FRAME.unpack_from(self.map, offset)
+        return timestamp / 1e6, memoryview(self.map)[offset + FRAME.size:offset + FRAME.size + length]
+
+    def readings(self, start=None, end=None, address=None):
+        """ Yields the decoded frames in a time range as dictionaries
+        """
+        for timestamp, raw in self.frames(start, end, address):
+            for packet in self.stick.parse(raw):
+                message = self.stick.get_wmbus_message(packet)
+                try:
+                    frame = WMBusFrame()
+                    frame.parse(message, {}, self.layout_cache, lazy=True)
+                    reading = {"Timestamp": timestamp,
+                               "Address": SMI260Commands.address_from_byte(frame.address[0:3]),
+                               "RSSI": packet.rssi}
+                    reading.update(decode_reading(frame, len(message)))
+                except Exception as ex:
+                    self.errors += 1
+                    logger.debug("skipping frame %s: %s", HexDump(message), ex)
+                    continue
+                yield reading
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def export(archive, output, start, end, address, format):
+    columns = ("Timestamp", "Address", "RSSI") + FIELDS
+    if format == 'csv':
+        writer = csv.DictWriter(output, columns)
+        writer.writeheader()
+        for reading in archive.readings(start, end, address):
+            reading["Timestamp"] = datetime.datetime.fromtimestamp(reading["Timestamp"]).isoformat()
+            writer.writerow(reading)
+    else:
+        output.write('[')
+        for number, reading in enumerate(archive.readings(start, end, address)):
+            output.write((',\n' if number else '\n') + json.dumps(reading, separators=(',', ':')))
+        output.write('\n]\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds and queries archives of stick captures')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    build_parser = commands.add_parser('build', help='builds an archive from capture files')
+    build_parser.add_argument('archive', help='archive file to write')
+    build_parser.add_argument('captures', nargs='+', help='capture files recorded with CAPTURE_DIR')
+    build_parser.add_argument('--index-every', type=int, default=256, help='frames per entry of the time index')
+
+    export_parser = commands.add_parser('export', help='exports the decoded frames of a time range')
+    export_parser.add_argument('archive', help='archive file to read')
+    export_parser.add_argument('--address', help='address of the inverter')
+    export_parser.add_argument('--start', type=parse_time, help='local start time, e.g. 2024-06-14T12:00')
+    export_parser.add_argument('--end', type=parse_time, help='local end time, e.g. 2024-06-14T13:00')
+    export_parser.add_argument('--format', choices=['csv', 'json'], default='csv', help='output format')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        print("archived %d frames" % build(args.archive, args.captures, args.index_every))
+    else:
+        archive = SMI260Archive(args.archive)
+        try:
+            export(archive, sys.stdout, args.start, args.end, args.address, args.format)
+            if archive.errors:
+                print("skipped %d frames which could not be decoded" % archive.errors, file=sys.stderr)
+        finally:
+            archive.close()
+
+
+if __name__ == "__main__":
+    main()
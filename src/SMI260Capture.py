@@ -0,0 +1,76 @@
+import os
+import struct
+import time
+
+MAGIC = b'SMICAP1\n'
+RECORD = struct.Struct('<QBH')  # timestamp in microseconds since the epoch, direction, length
+MAX_CHUNK = 0xFFFF
+
+RECEIVED = 0  # data received from the stick
+WRITTEN = 1  # data written to the stick
+
+
+class CaptureWriter:
+    """ Appends timestamped chunks of raw serial data to a capture file
+
+    The file starts with MAGIC followed by one record per chunk: an 11 byte
+    header of timestamp, direction and length, then the data itself.
+    """
+
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(MAGIC)
+        self.chunks = 0
+
+    def write(self, direction, data, timestamp=None):
+        timestamp = int((time.time() if timestamp is None else timestamp) * 1e6)
+        for start in range(0, len(data), MAX_CHUNK):
+            chunk = data[start:start + MAX_CHUNK]
+            self.file.write(RECORD.pack(timestamp, direction, len(chunk)))
+            self.file.write(chunk)
+            self.chunks += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader:
+    """ Iterates over the chunks of a capture file as tuples of timestamp, direction and data
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as capture:
+            if capture.read(len(MAGIC)) != MAGIC:
+                raise ValueError(self.path + " is not a capture file")
+
+            while True:
+                header = capture.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                timestamp, direction, length = RECORD.unpack(header)
+                data = capture.read(length)
+                if len(data) < length:
+                    return  # the last chunk was cut off while it was written
+                yield timestamp / 1e6, direction, data
+
+
+class RecordingTransport:
+    """ Wraps a transport and records everything written to it
+    """
+
+    def __init__(self, transport, capture):
+        self.transport = transport
+        self.capture = capture
+
+    def write(self, data):
+        self.capture.write(WRITTEN, data)
+        self.transport.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
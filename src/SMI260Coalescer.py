@@ -0,0 +1,76 @@
+import asyncio
+
+
+class SMI260Coalescer:
+    """ Coalesces the MaxPower/PowerOn targets set for an inverter
+
+    Targets submitted within window seconds are combined and only the latest
+    one is sent as a single change_state command when the window closes.
+    With leading_edge the first target of a quiet inverter is sent right
+    away and the window only collects the targets following it. A target is
+    not sent if it equals the last known state of the inverter, which is the
+    state it confirmed or the target sent to it afterwards. A state report
+    of the inverter supersedes a target which was already sent, and a
+    pending target the report confirms is not sent at all.
+
+    send is called with the address, the target (max_power, on) and the
+    arrival time of the oldest command it contains.
+    """
+
+    def __init__(self, send, window=1.0, leading_edge=True):
+        self.send = send
+        self.window = window
+        self.leading_edge = leading_edge
+        self.targets = {}
+        self.confirmed = {}
+        self.known = {}
+        self.pending = {}
+        self.timers = {}
+        self.submitted = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def target(self, address):
+        """ Returns the latest target of an inverter, or its confirmed state
+        """
+        return self.targets.get(address, self.confirmed.get(address))
+
+    def confirm(self, address, target):
+        self.confirmed[address] = target
+        self.known[address] = target
+        if address not in self.pending:
+            self.targets.pop(address, None)
+        elif self.targets[address] == target:
+            del self.pending[address]
+            del self.targets[address]
+            self.dropped += 1
+
+    def submit(self, address, target, received):
+        self.submitted += 1
+        self.targets[address] = target
+        self.pending.setdefault(address, received)
+
+        if address in self.timers:
+            return
+
+        if self.leading_edge:
+            self.flush(address)
+        self.timers[address] = asyncio.get_event_loop().call_later(self.window, self.close_window, address)
+
+    def close_window(self, address):
+        del self.timers[address]
+        if address in self.pending:
+            self.flush(address)
+            if self.leading_edge:
+                self.timers[address] = asyncio.get_event_loop().call_later(self.window, self.close_window, address)
+
+    def flush(self, address):
+        received = self.pending.pop(address)
+        target = self.targets[address]
+        if target == self.known.get(address):
+            self.dropped += 1
+            return
+
+        self.known[address] = target
+        self.sent += 1
+        self.send(address, target, received)
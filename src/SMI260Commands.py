@@ -1,50 +1,105 @@
 from IM871 import IM871, ControlFieldFlags, EndpointID, RadioLinkMessageIdentifier, Packet
 
+MANUFACTURER = bytes.fromhex('B4 B0')  # manufacturer field of the SMI260 inverters
+STATE_RESPONSE_LENGTH = 33  # length of the wM-Bus reply to query_state
+SETTINGS_RESPONSE_LENGTH = 93  # length of the wM-Bus reply to query_settings
+
+CHANGE_STATE_TEMPLATE = bytes.fromhex(
+    '44 B4 B0 00 00 00 00 01 02 51 0C 79 00 00 00 00 12 2B 8C 00 02 7C 07 69 68 70 5F 73 6F 63 E8 03 01 FD 66 01')
+QUERY_STATE_TEMPLATE = bytes.fromhex('5B B4 B0 00 00 00 00 01 02 51 0C 79 00 00 00 00')
+QUERY_SETTINGS_TEMPLATE = bytes.fromhex('5B B4 B0 00 00 00 00 01 02 51 0C 79 00 00 00 00 00 FF A7')
+
+FIELDS = ('Status', 'Energy', 'Power', 'MaxPower', 'PowerOn', 'DCVoltage', 'TemperatureDCAC', 'TemperatureDCDC',
+          'Frequency')
+
+
+def decode_reading(frame, length):
+    """ Returns the values of a parsed response to query_state or query_settings
+
+    length is the length of the wM-Bus message, which tells the responses
+    apart. Other frames decode to an empty dictionary.
+    """
+    reading = {}
+    if length == STATE_RESPONSE_LENGTH:
+        reading["Status"] = frame.header.status
+        reading["Energy"] = frame.records[0].get_energy_in_wh()
+        reading["Power"] = frame.records[1].get_power_in_w()
+
+    elif length == SETTINGS_RESPONSE_LENGTH:
+        reading["MaxPower"] = frame.records[0].get_power_in_w()
+
+        locval = frame.records[6].value[::-1]
+        # power on
+        reading["PowerOn"] = int(locval[9])  # maybe a side effect ?
+        # dc sec
+        reading["DCVoltage"] = int.from_bytes(locval[9:11], 'big') / 10
+        # temp dc/ac
+        reading["TemperatureDCAC"] = int.from_bytes(locval[24:26], 'big') / 10
+        # temp dc/dc
+        reading["TemperatureDCDC"] = int.from_bytes(locval[36:38], 'big') / 10
+        # freq
+        reading["Frequency"] = int.from_bytes(locval[49:51], 'big') / 100
+
+    return reading
+
 
 class SMI260Commands:
     def __init__(self):
         self.stick = IM871()
+        self.change_state_frames = {}
+        self.query_state_frames = {}
+        self.query_settings_frames = {}
 
     def change_state(self, address, max_power_output, on):
-        packet = Packet()
-        packet.control_field = ControlFieldFlags.CRC16Field
-        packet.endpoint_id = EndpointID.RADIOLINK_ID
-        packet.message_id = RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ
+        frame = self.change_state_frames.get(address)
+        if frame is None:
+            frame = self.build(self.set_address(address, bytearray(CHANGE_STATE_TEMPLATE)))
+            self.change_state_frames[address] = frame
 
-        bytepower = bytearray(max_power_output.to_bytes(2, 'little'))
-        byteon = bytearray(on.to_bytes(1, 'little'))
-        message = self.set_address(address, bytearray.fromhex(
-            '44 B4 B0 00 00 00 00 01 02 51 0C 79 00 00 00 00 12 2B 8C 00 02 7C 07 69 68 70 5F 73 6F 63 E8 03 01 FD 66 01'))
+        # the payload follows the 4 byte header, the CRC the payload
+        message = bytearray(frame)
+        message[4 + 18:4 + 20] = max_power_output.to_bytes(2, 'little')
+        message[4 + 35] = on
+        crc = self.stick.crc16(memoryview(message)[1:-2])
+        message[-2] = crc & 0xff
+        message[-1] = crc >> 8 & 0xff
+        return message
 
-        message[18] = bytepower[0]
-        message[19] = bytepower[1]
-        message[35] = byteon[0]
+    def change_state_bulk(self, targets):
+        """ Builds the change_state commands of many inverters in one pass
 
-        packet.payload = message
-        return self.stick.build(packet)
+        targets maps the address of an inverter to a tuple of its maximum
+        power output and power state. Returns a dictionary of the commands by
+        address.
+        """
+        return {address: self.change_state(address, max_power_output, on)
+                for address, (max_power_output, on) in targets.items()}
 
     def query_state(self, address):
-        packet = Packet()
-        packet.control_field = ControlFieldFlags.CRC16Field
-        packet.endpoint_id = EndpointID.RADIOLINK_ID
-        packet.message_id = RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ
-        packet.payload = self.set_address(address,
-                                              bytearray.fromhex('5B B4 B0 00 00 00 00 01 02 51 0C 79 00 00 00 00'))
-        return self.stick.build(packet)
+        frame = self.query_state_frames.get(address)
+        if frame is None:
+            frame = bytes(self.build(self.set_address(address, bytearray(QUERY_STATE_TEMPLATE))))
+            self.query_state_frames[address] = frame
+        return frame
 
     def query_settings(self, address):
+        frame = self.query_settings_frames.get(address)
+        if frame is None:
+            frame = bytes(self.build(self.set_address(address, bytearray(QUERY_SETTINGS_TEMPLATE))))
+            self.query_settings_frames[address] = frame
+        return frame
+
+    def build(self, message):
         packet = Packet()
         packet.control_field = ControlFieldFlags.CRC16Field
         packet.endpoint_id = EndpointID.RADIOLINK_ID
         packet.message_id = RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ
-        packet.payload = self.set_address(address,
-                                              bytearray.fromhex('5B B4 B0 00 00 00 00 01 02 51 0C 79 00 00 00 00 00 FF A7'))
+        packet.payload = message
         return self.stick.build(packet)
 
     @staticmethod
     def address_from_byte(byte_address):
-        byte_address.reverse()
-        return byte_address.hex().lstrip("0")
+        return byte_address[::-1].hex().lstrip("0")
 
     @staticmethod
     def byte_from_address(address):
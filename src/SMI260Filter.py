@@ -0,0 +1,38 @@
+from SMI260Commands import SMI260Commands, MANUFACTURER
+
+
+class SMI260Filter:
+    """ Drops wM-Bus messages of foreign meters before they are parsed
+
+    Messages are compared by their raw manufacturer and address bytes with
+    the encoded addresses of the configured inverters. To still see foreign
+    traffic for diagnostics, every sample_every-th dropped message is
+    accepted anyway. A sample_every of 0 disables sampling.
+    """
+
+    def __init__(self, addresses, manufacturer=MANUFACTURER, sample_every=0):
+        self.addresses = frozenset(bytes(SMI260Commands.byte_from_address(address)) for address in addresses)
+        self.manufacturer = bytes(manufacturer)
+        self.sample_every = sample_every
+        self.accepted = 0
+        self.dropped = 0
+        self.sampled = 0
+
+    def own(self, message):
+        """ Returns True if message, starting with its length field, was sent by a configured inverter
+        """
+        return len(message) >= 10 and message[2:4] == self.manufacturer and bytes(message[4:7]) in self.addresses
+
+    def accept(self, message):
+        """ Returns True if message, starting with its length field, should be parsed
+        """
+        if self.own(message):
+            self.accepted += 1
+            return True
+
+        self.dropped += 1
+        if self.sample_every and self.dropped % self.sample_every == 0:
+            self.sampled += 1
+            return True
+
+        return False
@@ -0,0 +1,193 @@
+import asyncio
+import collections
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+UDP_PAYLOAD_SIZE = 1400  # keeps datagrams below the usual MTU
+
+
+def escape_measurement(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_tag(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def format_field(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return str(value) + 'i'
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+class SMI260InfluxSink:
+    """ Writes the readings of the inverters to InfluxDB in line protocol
+
+    url is either udp://host:port or the http(s) write endpoint of InfluxDB,
+    e.g. http://host:8086/write?db=solar or
+    http://host:8086/api/v2/write?org=home&bucket=solar together with a
+    token. Lines are collected and written as one batch once batch_size
+    bytes are pending or flush_interval seconds after the first pending
+    line. At most max_pending lines are kept while InfluxDB is not reachable;
+    beyond that the oldest lines are dropped. close writes the pending lines
+    right away.
+    """
+
+    def __init__(self, url, measurement='smi260', batch_size=65536, flush_interval=1.0, max_pending=100000,
+                 token=None):
+        self.url = urlsplit(url)
+        if self.url.scheme not in ('udp', 'http', 'https'):
+            raise ValueError("unsupported InfluxDB url " + url)
+        self.measurement = escape_measurement(measurement)
+        self.batch_size = batch_size if self.url.scheme != 'udp' else min(batch_size, UDP_PAYLOAD_SIZE)
+        self.flush_interval = flush_interval
+        self.token = token
+        self.lines = collections.deque()
+        self.pending_bytes = 0
+        self.max_pending = max_pending
+        self.ready = asyncio.Event()
+        self.full = asyncio.Event()
+        self.udp = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failures = 0
+        self.last_batch_size = 0
+
+    def pending(self):
+        return len(self.lines)
+
+    def format(self, address, reading, timestamp):
+        fields = ','.join(escape_tag(field) + '=' + format_field(value) for field, value in reading.items())
+        # rounded to microseconds, the nanoseconds of a float timestamp are noise
+        return "%s,address=%s %s %d" % (self.measurement, escape_tag(address), fields, round(timestamp * 1e6) * 1000)
+
+    def write(self, address, reading, timestamp):
+        """ Queues a reading, timestamp is in seconds since the epoch
+        """
+        if not reading:
+            return
+
+        line = self.format(address, reading, timestamp).encode()
+        self.lines.append(line)
+        self.pending_bytes += len(line) + 1
+        while len(self.lines) > self.max_pending:
+            self.pending_bytes -= len(self.lines.popleft()) + 1
+            self.dropped += 1
+
+        self.ready.set()
+        if self.pending_bytes >= self.batch_size:
+            self.full.set()
+
+    def batch(self):
+        """ Removes and returns the oldest lines which fit into one batch
+        """
+        lines = []
+        size = 0
+        while self.lines and (not lines or size + len(self.lines[0]) + 1 <= self.batch_size):
+            line = self.lines.popleft()
+            lines.append(line)
+            size += len(line) + 1
+        self.pending_bytes -= size
+        return lines
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            if not self.full.is_set():
+                # give more lines the chance to join the batch
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            while self.lines:
+                lines = self.batch()
+                try:
+                    await self.send(b'\n'.join(lines) + b'\n')
+                except (OSError, asyncio.TimeoutError) as ex:
+                    logger.warning("writing to InfluxDB failed: %s", ex)
+                    self.failures += 1
+                    self.requeue(lines)
+                    await asyncio.sleep(min(self.flush_interval * 2 ** min(self.failures, 6), 60))
+                    continue
+                except asyncio.CancelledError:
+                    # keep the batch for close
+                    self.requeue(lines)
+                    raise
+
+                self.failures = 0
+                self.sent(lines)
+
+            self.ready.clear()
+            self.full.clear()
+
+    async def close(self):
+        """ Writes all pending lines without waiting for the flush interval
+
+        The task of run has to be cancelled before. Lines which cannot be
+        written are dropped.
+        """
+        while self.lines:
+            lines = self.batch()
+            try:
+                await self.send(b'\n'.join(lines) + b'\n')
+            except (OSError, asyncio.TimeoutError) as ex:
+                logger.warning("writing to InfluxDB failed, dropping %d lines: %s", len(lines) + len(self.lines), ex)
+                self.dropped += len(lines) + len(self.lines)
+                self.lines.clear()
+                self.pending_bytes = 0
+                break
+            self.sent(lines)
+
+        if self.udp is not None:
+            self.udp.close()
+            self.udp = None
+
+    def sent(self, lines):
+        self.batches += 1
+        self.written += len(lines)
+        self.last_batch_size = len(lines)
+
+    def requeue(self, lines):
+        """ Puts the lines of a failed batch back in front of the pending lines
+        """
+        for line in reversed(lines):
+            self.lines.appendleft(line)
+            self.pending_bytes += len(line) + 1
+        while len(self.lines) > self.max_pending:
+            self.pending_bytes -= len(self.lines.popleft()) + 1
+            self.dropped += 1
+
+    async def send(self, body):
+        if self.url.scheme == 'udp':
+            if self.udp is None:
+                self.udp, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+                    asyncio.DatagramProtocol, remote_addr=(self.url.hostname, self.url.port or 8089))
+            self.udp.sendto(body)
+            return
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.url.hostname, self.url.port or (443 if self.url.scheme == 'https' else 80),
+                                    ssl=self.url.scheme == 'https'), self.flush_interval * 10)
+        try:
+            path = (self.url.path or '/write') + ('?' + self.url.query if self.url.query else '')
+            headers = "POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: text/plain; charset=utf-8\r\n" \
+                      "Content-Length: %d\r\nConnection: close\r\n" % (path, self.url.netloc, len(body))
+            if self.token:
+                headers += "Authorization: Token %s\r\n" % self.token
+            writer.write((headers + "\r\n").encode() + body)
+            await writer.drain()
+
+            status = await asyncio.wait_for(reader.readline(), self.flush_interval * 10)
+            parts = status.split()
+            if len(parts) < 2 or not parts[1].startswith(b'2'):
+                raise OSError("InfluxDB answered " + status.decode(errors='replace').strip())
+        finally:
+            writer.close()
@@ -0,0 +1,38 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+def parse_levels(config):
+    """ Parses levels per logger like 'IM871=DEBUG,wmbus=WARNING'
+    """
+    levels = {}
+    for entry in filter(None, config.split(',')):
+        name, level = entry.split('=')
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level='INFO', levels=None):
+    """ Logs to stderr through a queue so the event loop never waits for the output
+
+    Records are formatted in the thread which logs them and written by a
+    QueueListener thread. levels maps logger names to their own level.
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, handler)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
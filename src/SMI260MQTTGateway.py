@@ -1,28 +1,130 @@
 import os
+import json
 import asyncio
-import copy
-import datetime
+import logging
+import time
 import serial_asyncio
 import paho.mqtt.client as mqtt
-from IM871 import IM871, EndpointID, RadioLinkMessageIdentifier
-from SMI260Commands import SMI260Commands
-from wmbus import WMBusFrame
+from IM871 import IM871, IM871Framer, EndpointID, RadioLinkMessageIdentifier
+from SMI260Commands import SMI260Commands, STATE_RESPONSE_LENGTH, SETTINGS_RESPONSE_LENGTH, decode_reading
+from SMI260Filter import SMI260Filter
+from SMI260Shards import SMI260Shards
+from SMI260Coalescer import SMI260Coalescer
+from SMI260PublishFilter import SMI260PublishFilter
+from SMI260Spool import SMI260Spool
+from SMI260InfluxSink import SMI260InfluxSink
+from SMI260Scheduler import PollScheduler, PollSettings, QUERY_STATE, QUERY_SETTINGS
+from IM871Transmitter import IM871Transmitter, PRIORITY_COMMAND, PRIORITY_REFRESH, PRIORITY_POLL
+from wmbus import WMBusFrame, WMBusLayoutCache
+from SMI260Logging import setup_logging, parse_levels
+from SMI260Metrics import counter, gauge, histogram, serve as serve_metrics
+from SMI260Capture import CaptureWriter, RecordingTransport, RECEIVED
+from util import HexDump
 
 
 from functools import partial
 
-debug = False
+logger = logging.getLogger('SMI260MQTTGateway')
 
 smi_list = []
 mqtt_common_topic = "SMI"
+layout_cache = WMBusLayoutCache()
 mqtt_client = mqtt.Client(client_id="SMI260MQTTGateway", clean_session=True, userdata=None, protocol=mqtt.MQTTv311)
 
+FRAMES = counter('smi260_frames_total', 'wM-Bus frames received from configured inverters', ('port',))
+DECODE_ERRORS = counter('smi260_decode_errors_total', 'Frames which could not be decoded', ('port',))
+READINGS = counter('smi260_readings_total', 'Readings decoded per inverter', ('address', 'query'))
+DECODE_SECONDS = histogram('smi260_decode_seconds', 'Time to decode and publish a frame',
+                           buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+QUERY_SECONDS = histogram('smi260_query_seconds', 'Time from writing a query to its response', ('address', 'query'))
+QUERY_TIMEOUTS = counter('smi260_query_timeouts_total', 'Queries which were not answered in time', ('address', 'query'))
+MQTT_PUBLISHES = counter('smi260_mqtt_publishes_total', 'Messages handed to the MQTT client')
+MQTT_SENT = counter('smi260_mqtt_sent_total', 'Messages the MQTT client has sent')
+MQTT_LOST = counter('smi260_mqtt_lost_total', 'Messages the MQTT client dropped unsent when it reconnected')
+MQTT_BACKLOG = gauge('smi260_mqtt_backlog', 'Messages handed to the MQTT client and not sent yet',
+                     function=lambda: mqtt_backlog())
+
 
 
 def build_mqtt_topic(device, topic):
     return mqtt_common_topic + "/" + device + "/" + topic
 
 
+def mqtt_publish(topic, payload):
+    MQTT_PUBLISHES.inc()
+    mqtt_client.publish(topic, payload)
+
+
+def on_publish(client, userdata, mid):
+    MQTT_SENT.inc()
+
+
+def mqtt_backlog():
+    # a message published right before a reconnect may still be sent after it was counted as lost
+    return max(MQTT_PUBLISHES.value - MQTT_SENT.value - MQTT_LOST.value, 0)
+
+
+def publish(state, address, field, value):
+    """ Publishes a value of an inverter unless the publish filter suppresses it
+    """
+    topic = build_mqtt_topic(address, field)
+    if state.publish_filter.accept(topic, field, value):
+        mqtt_publish(topic, str(value))
+
+
+def publish_reading(state, address, reading, timestamp):
+    """ Publishes the values decoded from a frame of an inverter
+
+    Depending on the publish mode every value goes to its own topic and/or
+    the latest values of all fields go to the state topic as one JSON
+    document with the sample timestamp in seconds since the epoch. While
+    the broker is not connected the JSON document is spooled instead and
+    replayed to the state topic later. Until the spool is empty new
+    documents are spooled behind the older ones, so the state topic keeps
+    their order. The values also go to InfluxDB if it is configured.
+    """
+    if state.influx is not None:
+        state.influx.write(address, reading, timestamp)
+
+    if not state.publish_topics and not state.publish_json:
+        return
+
+    snapshot = state.snapshots.setdefault(address, {})
+    snapshot.update(reading)
+    snapshot["Timestamp"] = round(timestamp, 3)
+    document = json.dumps(snapshot, separators=(',', ':'))
+
+    connected = state.mqtt_connected.is_set()
+    spooled = state.spool is not None and (not connected or state.publish_json and not state.spool.empty())
+    if spooled:
+        state.spool.append(address, document, timestamp)
+        if not connected:
+            return
+
+    if state.publish_topics:
+        for field, value in reading.items():
+            publish(state, address, field, value)
+
+    if state.publish_json and not spooled:
+        mqtt_publish(build_mqtt_topic(address, "state"), document)
+
+
+def replay_document(address, document, timestamp):
+    mqtt_publish(build_mqtt_topic(address, "state"), document)
+
+
+async def spool_task(state):
+    """ Replays the spooled state documents whenever the broker is connected
+    """
+    while True:
+        await state.mqtt_connected.wait()
+        await state.spool.replay(replay_document, state.mqtt_connected.is_set, state.spool_rate)
+        logger.info("replayed %d spooled messages, dropped %d", state.spool.replayed, state.spool.dropped)
+        # documents spooled during the replay or left by a disconnect are replayed right away
+        if state.spool.empty():
+            await state.spool.appended.wait()
+
+
 def parse_mqtt_message(message):
     splits = message.topic.split('/')
     address = splits[1]
@@ -34,220 +136,482 @@ def parse_mqtt_message(message):
 def on_connect(client, userdata, flags, rc):
 
     if rc == 0:
-        print("Successfully connected to MQTT")
+        logger.info("Successfully connected to MQTT")
         mqtt_client.connected_flag=True
+        # paho drops the messages queued while it was not connected without calling on_publish
+        MQTT_LOST.inc(mqtt_backlog())
+        # the broker may have lost the last values, publish all of them again
+        userdata.loop.call_soon_threadsafe(userdata.publish_filter.reset)
+        userdata.loop.call_soon_threadsafe(userdata.mqtt_connected.set)
 
+        # the known settings stay valid, settings are only polled every SETTINGS_EVERY state polls
         for device in smi_list:
-            userdata.device_list[device] = {"Energy": None, "Power": None, "MaxPower": None, "PowerOn": None}
             client.subscribe(build_mqtt_topic(device, "MaxPower/Set"))
             client.subscribe(build_mqtt_topic(device, "PowerOn/Set"))
+            client.subscribe(build_mqtt_topic(device, "Refresh"))
     else:
-        print("Bad connection Returned code=",rc)
+        logger.error("Bad connection Returned code=%s", rc)
 
 def on_disconnect(client, userdata, rc):
-    print("disconnecting reason  "  +str(rc))
-    mqtt_client.connected_flag=True
+    logger.warning("disconnecting reason %s", rc)
+    mqtt_client.connected_flag=False
+    userdata.loop.call_soon_threadsafe(userdata.mqtt_connected.clear)
 
 
 def on_message(client, userdata, msg):
-    print(msg.topic + " " + str(msg.payload))
+    # runs on the paho network thread, the command is handled on the event loop
+    userdata.loop.call_soon_threadsafe(userdata.commands.put_nowait, (msg, time.monotonic()))
+
+
+async def command_task(state):
+    while True:
+        msg, received = await state.commands.get()
+        try:
+            handle_command(state, msg, received)
+        except Exception:
+            logger.exception("handling command %s failed", msg.topic)
+
+
+def handle_command(state, msg, received):
+    logger.info("%s %s", msg.topic, msg.payload)
     address, command, value = parse_mqtt_message(msg)
+    stick = state.sticks.get(state.shards.port_for(address))
+    if stick is None:
+        logger.warning("stick of SMI %s is not connected", address)
+        return
+
+    if command == "Refresh":
+        stick.scheduler.request_settings(address, True)
+        return
+
     int_val = int(value)
     changed = False
-    device = userdata.device_list[address]
+    max_power, power_on = state.coalescer.target(address) or (None, None)
     if command == "PowerOn":
         if 0 <= int_val <= 1:
-            device[command] = int_val
+            power_on = int_val
             changed = True
 
     elif command == "MaxPower":
         if 0 <= int_val <= 310:
-            device[command] = int_val
+            max_power = int_val
             changed = True
 
-    if changed and device["MaxPower"] is not None and device["PowerOn"] is not None:
-        cmd = SMI260Commands()
-        smimsg = cmd.change_state(address, device["MaxPower"], device["PowerOn"])
-        userdata.transport.write(smimsg)
+    if changed:
+        if max_power is None or power_on is None:
+            logger.warning("settings of SMI %s are not known yet", address)
+        else:
+            state.coalescer.submit(address, (max_power, power_on), received)
 
 
-def update_topic(data, state):
+def send_change_state(state, address, target, received):
+    stick = state.sticks.get(state.shards.port_for(address))
+    if stick is None:
+        logger.warning("stick of SMI %s is not connected", address)
+        return
+
+    max_power, power_on = target
+    smimsg = stick.smi.change_state(address, max_power, power_on)
+    written = stick.transmitter.send(smimsg, PRIORITY_COMMAND)
+    written.add_done_callback(partial(log_command_latency, state, address, received))
+    stick.scheduler.request_settings(address, True)
+
+
+def log_command_latency(state, address, received, written):
+    state.command_latency = written.result() - received
+    logger.info("command to SMI %s written after %.1f ms", address, state.command_latency * 1000)
+
+
+def update_topic(data, state, timestamp):
+    """ Publishes the values of a received frame
+
+    timestamp is the time the frame was received in seconds since the epoch.
+    Returns the address and the frame if it was sent by a configured inverter,
+    otherwise None.
+    """
     frame = WMBusFrame()
-    frame.parse(data, {})
+    frame.parse(data, {}, layout_cache, lazy=True)
     byte_address = frame.address[0:3]
 
     address = SMI260Commands.address_from_byte(byte_address)
-    print("Manufacturer: " + str(frame.manufacturer.hex()))
-    print("Address: " + address)
-    if debug:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Manufacturer: %s, Address: %s", HexDump(frame.manufacturer), address)
         frame.log(2)
     if address in smi_list:
         device = state.device_list[address]
-        if len(data) == 33:
-            print("State query result :")
-            print("\tStatus : " + str(frame.header.status))
-            mqtt_client.publish(build_mqtt_topic(address, "Status"), str(frame.header.status))
-
-            record = frame.records[0]
-            val = record.get_energy_in_wh()
-            mqtt_client.publish(build_mqtt_topic(address, "Energy"), str(val))
-            device["Energy"] = val
-            print("\tEnergy: " + str(val))
-
-            record = frame.records[1]
-            val = record.get_power_in_w()
-            
+        reading = decode_reading(frame, len(data))
+        if "Energy" in reading:
+            device["Energy"] = reading["Energy"]
+
+        if "Power" in reading:
+            # sanitize values, empiric number due to swinging around max point + 5
             maxval = device["MaxPower"]
-            if maxval and val < (maxval + 5):  # sanitize values, empiric number due to swinging around max point + 5
-                mqtt_client.publish(build_mqtt_topic(address, "Power"), str(val))
-                device["Power"] = val
-                print("\tPower : " + str(val))
-
-        elif len(data) == 93:
-            print("Settings query result :")
-            record = frame.records[0]
-            val = record.get_power_in_w()
-            mqtt_client.publish(build_mqtt_topic(address, "MaxPower"), str(val))
-            device["MaxPower"] = val
-            print("\tMaxPower : " + str(val))
-
-            record = frame.records[6]
-            locval = copy.deepcopy(record.value)
-            locval.reverse()
-            # power on
-            power_val = int(locval[9])  # maybe a side effect ?
-            mqtt_client.publish(build_mqtt_topic(address, "PowerOn"), str(power_val))
-            device["PowerOn"] = power_val
-            print("\tPowerOn : " + str(power_val))
-
-            # dc sec
-            dc_val = int.from_bytes(locval[9:11], 'big') / 10
-            mqtt_client.publish(build_mqtt_topic(address, "DCVoltage"), str(dc_val))
-            print("\tDCVoltage : " + str(dc_val))
-
-            # temp dc/ac
-            temp_dcac_val = int.from_bytes(locval[24:26], 'big') / 10
-            mqtt_client.publish(build_mqtt_topic(address, "TemperatureDCAC"), str(temp_dcac_val))
-            print("\tTemperatureDCAC : " + str(temp_dcac_val))
-
-            # temp dc/dc
-            temp_dcdc_val = int.from_bytes(locval[36:38], 'big') / 10
-            mqtt_client.publish(build_mqtt_topic(address, "TemperatureDCDC"), str(temp_dcdc_val))
-            print("\tTemperatureDCDC : " + str(temp_dcdc_val))
-
-            # freq
-            freq_val = int.from_bytes(locval[49:51], 'big') / 100
-            mqtt_client.publish(build_mqtt_topic(address, "Frequency"), str(freq_val))
-            print("\tFrequency : " + str(freq_val))
-
-def printhex(data):
-    print(' '.join('{:02x}'.format(x) for x in data))
+            if maxval and reading["Power"] < (maxval + 5):
+                device["Power"] = reading["Power"]
+            else:
+                del reading["Power"]
+
+        if "MaxPower" in reading:
+            device["MaxPower"] = reading["MaxPower"]
+            device["PowerOn"] = reading["PowerOn"]
+            state.coalescer.confirm(address, (device["MaxPower"], device["PowerOn"]))
+
+        logger.info("SMI %s: %s", address, reading)
+        READINGS.labels(address, 'state' if len(data) == STATE_RESPONSE_LENGTH else 'settings').inc()
+        if reading:
+            publish_reading(state, address, reading, timestamp)
+        return address, frame
+
+    return None
+
+def log_foreign(message, rssi):
+    """ Logs a frame of a foreign meter sampled by FOREIGN_SAMPLE
+
+    Foreign frames are parsed for diagnostics only, a frame which cannot be
+    decoded is logged without a traceback.
+    """
+    if len(message) < 12:
+        logger.info("foreign frame with RSSI %s too short: %s", rssi, HexDump(message))
+        return
+
+    try:
+        frame = WMBusFrame()
+        frame.parse(message, {})
+    except Exception as ex:
+        logger.info("foreign frame with RSSI %s not decoded (%s): %s", rssi, ex, HexDump(message))
+        return
+
+    logger.info("foreign frame of %s %s, %s, RSSI %s, %d records", bytes(frame.get_manufacturer_short()[:3]).decode(),
+                HexDump(frame.get_device_id()), frame.get_device_type(), rssi, len(frame.records))
+
 
 class Communication(asyncio.Protocol):
-    def __init__(self, state):
+    """ Protocol of a stick, polls the inverters assigned to it and decodes what it receives
+
+    A passive stick only decodes the data it receives: it neither queries the
+    stick nor polls the inverters, e.g. to replay a capture.
+    """
+
+    def __init__(self, state, port, passive=False):
         super().__init__()
         self.transport = None
+        self.port = port
+        self.passive = passive
         self.smi = SMI260Commands()
+        self.stick = IM871()
+        self.framer = IM871Framer(self.stick)
+        self.transmitter = IM871Transmitter(state.duty_cycle, state.duty_cycle_window, state.chip_rate)
+        self.scheduler = PollScheduler(state.shards.addresses_of(port), state.poll_settings, state.poll_config,
+                                       state.max_query_rate, state.settings_every)
         self.state = state
+        self.outstanding = asyncio.Semaphore(state.max_outstanding)
+        self.pending = {}
+        self.capture = None
+        if state.capture_dir:
+            self.capture = CaptureWriter(os.path.join(state.capture_dir, os.path.basename(port) + '.smicap'))
+        self.frames = FRAMES.labels(port)
+        self.decode_errors = DECODE_ERRORS.labels(port)
 
     async def query(self):
+        scheduler = self.scheduler
         while True:
-            for device in smi_list:
-                print("["+ str(datetime.datetime.now()) + "] query SMI " + str(device))
-                print("--------------------------------------------")
-                message = self.smi.query_state(device)
-                self.transport.write(message)
-                await asyncio.sleep(0.5)
-                message = self.smi.query_settings(device)
-                self.transport.write(message)
-                await asyncio.sleep(2)
-
-            await asyncio.sleep(self.state.poll_every)
+            device, query = await scheduler.next()
+            if query == QUERY_STATE:
+                asyncio.ensure_future(self.poll_state(device))
+            elif query == QUERY_SETTINGS:
+                asyncio.ensure_future(self.poll_settings(device, PRIORITY_POLL))
+            else:
+                asyncio.ensure_future(self.poll_settings(device, PRIORITY_REFRESH))
+
+    async def poll_state(self, device):
+        reading = None
+        try:
+            frame = await self.query_state(device, self.state.query_timeout)
+            reading = (frame.records[1].get_power_in_w(), frame.header.status)
+        except asyncio.TimeoutError:
+            logger.warning("SMI %s did not answer state query", device)
+        except Exception:
+            logger.exception("state query of SMI %s failed", device)
+        finally:
+            self.scheduler.reschedule(device, reading)
+
+        owner = self.state.shards.polled(self.port, device)
+        if owner is not None and owner != self.port:
+            self.scheduler.remove(device)
+
+    async def poll_settings(self, device, priority):
+        try:
+            await self.query_settings(device, self.state.query_timeout, priority)
+        except asyncio.TimeoutError:
+            logger.warning("SMI %s did not answer settings query", device)
+        except Exception:
+            logger.exception("settings query of SMI %s failed", device)
+        finally:
+            self.scheduler.settings_polled(device)
+
+    async def query_state(self, address, timeout, priority=PRIORITY_POLL):
+        """ Queries the state of an inverter and returns the received frame
+
+        Raises asyncio.TimeoutError if the inverter does not answer in time.
+        """
+        return await self.request(address, STATE_RESPONSE_LENGTH, self.smi.query_state(address), timeout, priority)
+
+    async def query_settings(self, address, timeout, priority=PRIORITY_POLL):
+        """ Queries the settings of an inverter and returns the received frame
+
+        Raises asyncio.TimeoutError if the inverter does not answer in time.
+        """
+        return await self.request(address, SETTINGS_RESPONSE_LENGTH, self.smi.query_settings(address), timeout,
+                                  priority)
+
+    async def request(self, address, response_length, message, timeout, priority):
+        """ Sends message and waits for the response of address
+
+        Responses are told apart by their length. At most max_outstanding
+        requests are waiting for their response at the same time. The
+        timeout starts once the transmitter has written the message.
+        """
+        async with self.outstanding:
+            logger.debug("query SMI %s", address)
+            key = (address, response_length)
+            future = asyncio.get_event_loop().create_future()
+            self.pending.setdefault(key, []).append(future)
+            query = 'state' if response_length == STATE_RESPONSE_LENGTH else 'settings'
+            try:
+                written = await self.transmitter.send(message, priority)
+                frame = await asyncio.wait_for(future, timeout)
+                QUERY_SECONDS.labels(address, query).observe(time.monotonic() - written)
+                return frame
+            except asyncio.TimeoutError:
+                QUERY_TIMEOUTS.labels(address, query).inc()
+                raise
+            finally:
+                futures = self.pending.get(key, [])
+                if future in futures:
+                    futures.remove(future)
+                if not futures:
+                    self.pending.pop(key, None)
+                future.cancel()
+
+    def resolve(self, address, response_length, frame):
+        for future in self.pending.get((address, response_length), []):
+            if not future.done():
+                future.set_result(frame)
 
     def connection_made(self, transport):
         self.transport = transport
-        self.state.transport = transport
-        print('port opened', transport)
-
+        self.state.sticks[self.port] = self
+        self.transmitter.transport = transport if self.capture is None else RecordingTransport(transport, self.capture)
+        self.framer.reset()
+        logger.info("port %s opened", self.port)
+        if self.passive:
+            return
+
+        asyncio.ensure_future(self.transmitter.run())
         # query stick
-        self.transport.write(bytearray().fromhex('A5 81 0F 00 34 13'))
+        self.transmitter.send(bytearray().fromhex('A5 81 0F 00 34 13'), PRIORITY_COMMAND)
         asyncio.ensure_future(self.query())
 
     def data_received(self, data):
-        print("["+ str(datetime.datetime.now()) + "] data received")
-        
-        if debug: 
-            
-            printhex(data)
-
-        stick = IM871()
-        packets = stick.parse(data)
+        self.receive(data, time.time())
+
+    def receive(self, data, timestamp):
+        """ Decodes data received at timestamp, in seconds since the epoch
+        """
+        logger.debug("data received: %s", HexDump(data))
+        if self.capture is not None:
+            self.capture.write(RECEIVED, data, timestamp)
+
+        packets = self.framer.feed(data)
         for packet in packets:
             if packet.endpoint_id == EndpointID.RADIOLINK_ID and (
                     packet.message_id == RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_IND or
                     packet.message_id == RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ):
+                message = self.stick.get_wmbus_message(packet)
+                if not self.state.frame_filter.accept(message):
+                    continue
+                if not self.state.frame_filter.own(message):
+                    log_foreign(message, packet.rssi)
+                    continue
+
+                if len(message) >= 7:
+                    address = SMI260Commands.address_from_byte(message[4:7])
+                    self.state.shards.heard(self.port, address, packet.rssi)
+                    owner = self.state.shards.owner(address)
+                    if owner is not None and owner != self.port:
+                        continue  # published by the stick the inverter is assigned to
+
+                self.frames.inc()
+                started = time.perf_counter()
                 try:
-                    update_topic(stick.get_wmbus_message(packet), self.state)
-
-                except Exception as ex:
-                    print("Exception : ")
-                    print(ex)
-                    pass
+                    result = update_topic(message, self.state, timestamp)
+                    if result is not None:
+                        address, frame = result
+                        self.resolve(address, len(message), frame)
 
-            print("--------------------------------------------")
+                except Exception:
+                    self.decode_errors.inc()
+                    logger.exception("decoding frame %s failed", HexDump(message))
+                DECODE_SECONDS.observe(time.perf_counter() - started)
 
     def connection_lost(self, exc):
-        print('port closed')
+        logger.warning("port %s closed", self.port)
         self.transport.loop.stop()
 
     def pause_writing(self):
-        print('pause writing')
-        print(self.transport.get_write_buffer_size())
+        logger.info("pause writing, %d bytes buffered", self.transport.get_write_buffer_size())
+        self.transmitter.pause()
 
     def resume_writing(self):
-        print(self.transport.get_write_buffer_size())
-        print('resume writing')
+        logger.info("resume writing, %d bytes buffered", self.transport.get_write_buffer_size())
+        self.transmitter.resume()
 
 async def mqtt_task(async_state):
     mqtt_server = os.getenv('MQTTSERVER', '127.0.0.1')
-    mqtt_port = os.getenv('MQTTSERVERPORT', 1883)
-    print('MQTT Connecting to ' + mqtt_server + ':' + str(mqtt_port))
+    mqtt_port = int(os.getenv('MQTTSERVERPORT', 1883))
+    logger.info("MQTT Connecting to %s:%s", mqtt_server, mqtt_port)
     mqtt_client.user_data_set(async_state)
     mqtt_client.connected_flag=False
     mqtt_client.on_connect = on_connect
     mqtt_client.on_message = on_message
     mqtt_client.on_disconnect = on_disconnect
-    mqtt_client.connect(mqtt_server, mqtt_port, 30)
+    mqtt_client.on_publish = on_publish
+    # paho connects on its own thread and keeps retrying while the broker is not reachable
+    mqtt_client.connect_async(mqtt_server, mqtt_port, 30)
     mqtt_client.loop_start()
-    while True:
-        await asyncio.sleep(1.0)
-
+    await command_task(async_state)
+
+
+def register_metrics(state):
+    """ Registers the metrics which are read from the state of the gateway when they are collected
+    """
+    sticks = state.sticks
+    gauge('smi260_write_buffer_bytes', 'Bytes buffered by the serial transport', ('port',),
+          lambda: {port: stick.transport.get_write_buffer_size() for port, stick in sticks.items()})
+    gauge('smi260_transmit_queue', 'Messages waiting for the transmitter', ('port',),
+          lambda: {port: stick.transmitter.queue.qsize() for port, stick in sticks.items()})
+    counter('smi260_airtime_seconds_total', 'Airtime used by the messages sent', ('port',),
+            lambda: {port: stick.transmitter.airtime_used for port, stick in sticks.items()})
+    gauge('smi260_pending_queries', 'Queries waiting for their response', ('port',),
+          lambda: {port: sum(len(futures) for futures in stick.pending.values()) for port, stick in sticks.items()})
+    counter('smi260_foreign_frames_total', 'Frames of other meters dropped by the filter',
+            function=lambda: state.frame_filter.dropped)
+    counter('smi260_layout_cache_hits_total', 'wM-Bus frames decoded with a cached record layout',
+            function=lambda: layout_cache.hits)
+    counter('smi260_layout_cache_misses_total', 'wM-Bus frames whose record layout was not cached',
+            function=lambda: layout_cache.misses)
+    counter('smi260_suppressed_publishes_total', 'Values not published because they did not change',
+            function=lambda: state.publish_filter.suppressed)
+    counter('smi260_commands_sent_total', 'change_state commands sent after coalescing',
+            function=lambda: state.coalescer.sent)
+    counter('smi260_commands_dropped_total', 'Commands dropped because the inverter is already in the target state',
+            function=lambda: state.coalescer.dropped)
+    if state.spool is not None:
+        counter('smi260_spooled_total', 'Messages spooled while the broker was not connected',
+                function=lambda: state.spool.spooled)
+        counter('smi260_spool_replayed_total', 'Spooled messages replayed', function=lambda: state.spool.replayed)
+        counter('smi260_spool_dropped_total', 'Spooled messages dropped because of the size or age limit',
+                function=lambda: state.spool.dropped)
+    if state.influx is not None:
+        gauge('smi260_influx_pending', 'Lines waiting to be written to InfluxDB', function=state.influx.pending)
+        counter('smi260_influx_written_total', 'Lines written to InfluxDB', function=lambda: state.influx.written)
+        counter('smi260_influx_batches_total', 'Batches written to InfluxDB', function=lambda: state.influx.batches)
+        counter('smi260_influx_dropped_total', 'Lines dropped while InfluxDB was not reachable',
+                function=lambda: state.influx.dropped)
+        gauge('smi260_influx_last_batch_lines', 'Lines of the last batch written to InfluxDB',
+              function=lambda: state.influx.last_batch_size)
+
+
+def setup_logging_from_env():
+    debug = os.getenv('DEBUG', 'false').lower() in ('1', 'true', 'yes')
+    setup_logging('DEBUG' if debug else os.getenv('LOG_LEVEL', 'INFO').upper(),
+                  parse_levels(os.getenv('LOG_LEVELS', '')))
+
+
+def build_state(serial_ports):
+    """ Builds the state shared by all parts of the gateway from the environment
+    """
+    global smi_list, layout_cache
+
+    poll_settings = PollSettings(interval=int(os.getenv('POLL', 120)),
+                                 min_interval=int(os.getenv('POLL_MIN', 30)),
+                                 max_interval=int(os.getenv('POLL_MAX', 1800)),
+                                 night_interval=int(os.getenv('POLL_NIGHT', 900)),
+                                 backoff=float(os.getenv('POLL_BACKOFF', 2.0)))
+    smi_list = os.getenv('SMI_LIST', '7981').split(',')
+    layout_cache = WMBusLayoutCache(int(os.getenv('LAYOUT_CACHE_SIZE', 64)))
 
-def main():
-    global smi_list, debug
+    async_state = type('', (), {})()
+    async_state.device_list = {device: {"Energy": None, "Power": None, "MaxPower": None, "PowerOn": None}
+                               for device in smi_list}
+    async_state.sticks = {}
+    async_state.commands = asyncio.Queue()
+    async_state.command_latency = None
+    async_state.coalescer = SMI260Coalescer(partial(send_change_state, async_state),
+                                            float(os.getenv('COMMAND_WINDOW', 1.0)),
+                                            os.getenv('COMMAND_LEADING_EDGE', 'true').lower() in ('1', 'true', 'yes'))
+    async_state.shards = SMI260Shards(serial_ports, smi_list, SMI260Shards.parse(os.getenv('SMI_SHARDS', '')),
+                                      int(os.getenv('SHARD_UNHEARD_POLLS', 10)))
+    async_state.poll_settings = poll_settings
+    async_state.poll_config = {address: poll_settings.updated(values) for address, values in
+                               json.loads(os.getenv('POLL_CONFIG', '{}')).items()}
+    async_state.max_query_rate = float(os.getenv('MAX_QUERY_RATE', 1.0))
+    async_state.settings_every = int(os.getenv('SETTINGS_EVERY', 10))
+    async_state.query_timeout = float(os.getenv('QUERY_TIMEOUT', 3))
+    async_state.max_outstanding = int(os.getenv('MAX_OUTSTANDING', 1))
+    async_state.duty_cycle = float(os.getenv('DUTY_CYCLE', 0.01))
+    async_state.duty_cycle_window = float(os.getenv('DUTY_CYCLE_WINDOW', 3600))
+    async_state.chip_rate = int(os.getenv('RADIO_CHIP_RATE', 100000))
+    async_state.publish_filter = SMI260PublishFilter(
+        SMI260PublishFilter.parse(json.loads(os.getenv('PUBLISH_DEADBANDS', '{}'))),
+        float(os.getenv('PUBLISH_HEARTBEAT', 300)))
+    publish_mode = os.getenv('PUBLISH_MODE', 'topics')
+    if publish_mode not in ('topics', 'json', 'both', 'none'):
+        raise ValueError("unknown PUBLISH_MODE " + publish_mode)
+    async_state.publish_topics = publish_mode in ('topics', 'both')
+    async_state.publish_json = publish_mode in ('json', 'both')
+    async_state.snapshots = {}
+    async_state.mqtt_connected = asyncio.Event()
+    spool_dir = os.getenv('SPOOL_DIR', '')
+    async_state.spool = SMI260Spool(spool_dir, int(os.getenv('SPOOL_MAX_SIZE', 10 * 1024 * 1024)),
+                                    float(os.getenv('SPOOL_MAX_AGE', 7 * 24 * 3600))) if spool_dir else None
+    async_state.spool_rate = float(os.getenv('SPOOL_RATE', 10))
+    influx_url = os.getenv('INFLUX_URL', '')
+    async_state.influx = SMI260InfluxSink(influx_url, os.getenv('INFLUX_MEASUREMENT', 'smi260'),
+                                          int(os.getenv('INFLUX_BATCH_SIZE', 65536)),
+                                          float(os.getenv('INFLUX_FLUSH_INTERVAL', 1.0)),
+                                          int(os.getenv('INFLUX_MAX_PENDING', 100000)),
+                                          os.getenv('INFLUX_TOKEN')) if influx_url else None
+    async_state.frame_filter = SMI260Filter(smi_list, sample_every=int(os.getenv('FOREIGN_SAMPLE', 0)))
+    async_state.capture_dir = os.getenv('CAPTURE_DIR', '')
+    return async_state
 
-    serial_port = os.getenv('SUNSTICKPORT', '/dev/ttyUSB0')
 
-    poll_every = int(os.getenv('POLL', 120))
-    smi_list = os.getenv('SMI_LIST', '7981').split(',')
-    debug = os.getenv('DEBUG', False)
+def main():
+    setup_logging_from_env()
 
-    async_state = type('', (), {})()
-    async_state.device_list = {}
-    async_state.transport = None
-    async_state.poll_every = poll_every
+    serial_ports = os.getenv('SUNSTICKPORT', '/dev/ttyUSB0').split(',')
+    async_state = build_state(serial_ports)
 
     loop = asyncio.get_event_loop()
+    async_state.loop = loop
 
-    # setup serial connection
-    protocol = partial(Communication, async_state)
-    transport = serial_asyncio.create_serial_connection(loop, protocol, serial_port, baudrate=57600)
-    asyncio.ensure_future(transport)
-
-    async_state.transport = transport
+    # setup serial connections
+    for serial_port in serial_ports:
+        protocol = partial(Communication, async_state, serial_port)
+        transport = serial_asyncio.create_serial_connection(loop, protocol, serial_port, baudrate=57600)
+        asyncio.ensure_future(transport)
 
     # setup mqtt
     loop.create_task(mqtt_task(async_state))
+    metrics_port = int(os.getenv('METRICS_PORT', 0))
+    if metrics_port:
+        register_metrics(async_state)
+        loop.run_until_complete(serve_metrics(os.getenv('METRICS_HOST', '127.0.0.1'), metrics_port))
+    if async_state.spool is not None:
+        loop.create_task(spool_task(async_state))
+    if async_state.influx is not None:
+        loop.create_task(async_state.influx.run())
 
     loop.run_forever()
   
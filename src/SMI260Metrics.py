@@ -0,0 +1,192 @@
+import asyncio
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=''):
+    labels = ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                      for name, value in zip(names, values))
+    if extra:
+        labels = labels + ',' + extra if labels else extra
+    return '{' + labels + '}' if labels else ''
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """ Base of the metrics, a metric with label names holds one child per label values
+
+    A metric with a function is not updated by the code but calls the
+    function when it is collected. The function returns the value, or a
+    dictionary of values by label values.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.child()
+        return child
+
+    def child(self):
+        return type(self)(self.name, self.help)
+
+    def samples(self):
+        """ Returns the lines of the metric in the Prometheus text format
+        """
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return ['%s%s %s' % (self.name, format_labels(self.label_names, key if isinstance(key, tuple) else (key,)),
+                                 format_value(value)) for key, value in values.items()]
+
+        if self.label_names:
+            lines = []
+            for values, child in self.children.items():
+                lines.extend(child.child_samples(format_labels(self.label_names, values)))
+            return lines
+
+        return self.child_samples('')
+
+    def child_samples(self, labels):
+        return ['%s%s %s' % (self.name, labels, format_value(self.value))]
+
+    def expose(self):
+        return '\n'.join(['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)] +
+                         self.samples())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels, function)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels, function)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def child_samples(self, labels):
+        lines = []
+        cumulative = 0
+        inner = labels[1:-1]
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            le = 'le="%s"' % (bound if isinstance(bound, str) else repr(float(bound)))
+            lines.append('%s_bucket{%s} %d' % (self.name, inner + ',' + le if inner else le, cumulative))
+        lines.append('%s_sum%s %s' % (self.name, labels, format_value(self.sum)))
+        lines.append('%s_count%s %d' % (self.name, labels, self.count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """ Registers a metric, a metric registered again under its name replaces the old one
+        """
+        self.metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name):
+        self.metrics.pop(name, None)
+
+    def expose(self):
+        return ''.join(metric.expose() + '\n' for metric in self.metrics.values())
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help, labels=(), function=None):
+    return REGISTRY.register(Counter(name, help, labels, function))
+
+
+def gauge(name, help, labels=(), function=None):
+    return REGISTRY.register(Gauge(name, help, labels, function))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+
+async def serve(host, port, registry=REGISTRY):
+    """ Serves the metrics of registry on http://host:port/metrics
+    """
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # skip the request headers
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4', registry.expose().encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+
+            writer.write(('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                          % (status, content_type, len(body))).encode() + body)
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError) as ex:
+            logger.debug("metrics request failed: %s", ex)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info("serving metrics on %s:%d", host, port)
+    return server
@@ -0,0 +1,62 @@
+import time
+
+
+class SMI260PublishFilter:
+    """ Suppresses publishes of values which did not change
+
+    The last published value and time are kept per topic. A numeric value is
+    published if it differs from the last one by more than the deadband of
+    its field, any other value if it differs at all. deadbands maps a field
+    to a tuple of the absolute and the relative (to the last value) deadband;
+    the larger one applies. Every topic is published again after heartbeat
+    seconds of silence, a heartbeat of 0 publishes every value.
+    """
+
+    def __init__(self, deadbands=None, heartbeat=300):
+        self.deadbands = deadbands or {}
+        self.heartbeat = heartbeat
+        self.last = {}
+        self.published = 0
+        self.suppressed = 0
+
+    @staticmethod
+    def parse(config):
+        """ Parses deadbands like '{"Power": 2, "Energy": [0, 0.001]}'
+
+        A number is an absolute deadband, a list the absolute and the
+        relative deadband.
+        """
+        deadbands = {}
+        for field, deadband in config.items():
+            if isinstance(deadband, (int, float)):
+                deadbands[field] = (deadband, 0)
+            else:
+                absolute, relative = deadband
+                deadbands[field] = (absolute, relative)
+        return deadbands
+
+    def accept(self, topic, field, value, now=None):
+        """ Returns whether value is published on topic and if so notes it
+        """
+        now = time.monotonic() if now is None else now
+        last = self.last.get(topic)
+        if last is not None and now - last[1] < self.heartbeat and not self.changed(field, last[0], value):
+            self.suppressed += 1
+            return False
+
+        self.last[topic] = (value, now)
+        self.published += 1
+        return True
+
+    def changed(self, field, last, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                isinstance(last, bool) or not isinstance(last, (int, float)):
+            return value != last
+
+        absolute, relative = self.deadbands.get(field, (0, 0))
+        return abs(value - last) > max(absolute, relative * abs(last))
+
+    def reset(self):
+        """ Forgets all published values, so the next value of every topic is published
+        """
+        self.last.clear()
@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import logging
+import time
+import SMI260MQTTGateway as gateway
+from SMI260Capture import CaptureReader, RECEIVED
+from IM871 import PACKETS
+from wmbus import FRAMES
+
+logger = logging.getLogger('SMI260Replay')
+
+
+class ReplayTransport:
+    """ Stands in for the serial transport, messages written to it are dropped
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+
+async def replay(path, port, max_speed):
+    """ Feeds the data received in a capture through the pipeline of the gateway
+
+    The data is fed at its original timing, or as fast as possible with
+    max_speed. The settings are taken from the environment like the gateway
+    does, the MQTT broker is not connected, nothing is sent to the inverters
+    and nothing is spooled. Readings go to InfluxDB with the time of their
+    chunk in the capture. The tasks started for the replay are cancelled at the end of
+    the capture. Returns the protocol the data was fed to.
+    """
+    loop = asyncio.get_event_loop()
+    running = asyncio.all_tasks()
+    state = gateway.build_state([port])
+    state.loop = loop
+    state.capture_dir = ''
+    state.spool = None
+    if state.influx is not None:
+        loop.create_task(state.influx.run())
+
+    protocol = gateway.Communication(state, port, passive=True)
+    protocol.connection_made(ReplayTransport(loop))
+
+    chunks = 0
+    size = 0
+    first = None
+    started = time.monotonic()
+    for timestamp, direction, data in CaptureReader(path):
+        if direction != RECEIVED:
+            continue
+
+        if first is None:
+            first = timestamp
+        if not max_speed:
+            delay = (timestamp - first) - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        protocol.receive(data, timestamp)
+        chunks += 1
+        size += len(data)
+        await asyncio.sleep(0)
+
+    elapsed = time.monotonic() - started
+    logger.info("replayed %d chunks, %d bytes, %d packets, %d frames in %.3f s (%.1f frames/s)", chunks, size,
+                PACKETS.value, FRAMES.value, elapsed, FRAMES.value / elapsed if elapsed else 0)
+
+    tasks = asyncio.all_tasks() - running
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if state.influx is not None:
+        await state.influx.close()
+    return protocol
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a capture of the stick through the gateway')
+    parser.add_argument('capture', help='capture file recorded with CAPTURE_DIR')
+    parser.add_argument('--port', default='replay', help='name of the stick the capture is replayed as')
+    parser.add_argument('--max-speed', action='store_true', help='replay as fast as possible instead of in real time')
+    args = parser.parse_args()
+
+    gateway.setup_logging_from_env()
+    asyncio.get_event_loop().run_until_complete(replay(args.capture, args.port, args.max_speed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import asyncio
+import heapq
+import time
+
+QUERY_STATE = 'state'
+QUERY_SETTINGS = 'settings'
+QUERY_REFRESH = 'refresh'
+
+
+class PollSettings:
+    """ Poll intervals of an inverter in seconds
+
+    interval is used while the output is steady. It shrinks down to
+    min_interval while power or state change by more than change_threshold
+    (relative to the last value) and grows by backoff up to max_interval
+    while the inverter does not answer. night_interval is used as long as
+    the inverter reports no power.
+    """
+
+    def __init__(self, interval=120, min_interval=30, max_interval=1800, night_interval=900, backoff=2.0,
+                 change_threshold=0.1):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.night_interval = night_interval
+        self.backoff = backoff
+        self.change_threshold = change_threshold
+
+    def updated(self, values):
+        """ Returns a copy of the settings with the values of a dictionary replaced
+        """
+        settings = PollSettings(**vars(self))
+        for name, value in values.items():
+            if not hasattr(settings, name):
+                raise ValueError("unknown poll setting " + name)
+            setattr(settings, name, value)
+        return settings
+
+
+class PollScheduler:
+    """ Decides which inverter is polled next
+
+    Every inverter has its own next due time in a priority queue. After a
+    poll the inverter is rescheduled with an interval adapted to its last
+    readings. The total rate of polls is limited to max_rate per second.
+
+    The state of an inverter is polled on its schedule, its settings only
+    every settings_every-th state poll or whenever request_settings is
+    called. Queued entries are tuples of address and QUERY_STATE,
+    QUERY_SETTINGS or QUERY_REFRESH for settings requested on demand.
+    """
+
+    def __init__(self, addresses, default_settings=None, settings=None, max_rate=1.0, settings_every=10):
+        self.default_settings = default_settings or PollSettings()
+        self.settings = settings or {}
+        self.max_rate = max_rate
+        self.settings_every = settings_every
+        self.state_polls = {}
+        self.settings_pending = set()
+        self.removed = set()
+        self.queue = []
+        self.counter = 0
+        self.intervals = {}
+        self.failures = {}
+        self.readings = {}
+        self.last_poll = 0
+        self.wakeup = asyncio.Event()
+
+        for address in addresses:
+            self.intervals[address] = self.get_settings(address).interval
+            # the settings are needed first to sanitize the power readings
+            self.request_settings(address)
+            self.schedule((address, QUERY_STATE), time.monotonic())
+
+    def get_settings(self, address):
+        return self.settings.get(address, self.default_settings)
+
+    def schedule(self, entry, due):
+        heapq.heappush(self.queue, (due, self.counter, entry))
+        self.counter += 1
+        self.wakeup.set()
+
+    def remove(self, address):
+        """ Stops polling address, polls of it which are already queued are skipped
+        """
+        self.removed.add(address)
+        self.settings_pending.discard(address)
+
+    def request_settings(self, address, on_demand=False):
+        """ Queues a settings poll of address unless one is already pending
+        """
+        if address not in self.settings_pending and address not in self.removed:
+            self.settings_pending.add(address)
+            self.schedule((address, QUERY_REFRESH if on_demand else QUERY_SETTINGS), time.monotonic())
+
+    def settings_polled(self, address):
+        self.settings_pending.discard(address)
+
+    async def next(self):
+        """ Waits until the next poll is due and returns its address and query
+        """
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            due = now + 3600
+            if self.queue:
+                due = max(self.queue[0][0], self.last_poll + 1.0 / self.max_rate)
+                if self.queue[0][2][0] in self.removed:
+                    heapq.heappop(self.queue)
+                    continue
+                if due <= now:
+                    self.last_poll = now
+                    return heapq.heappop(self.queue)[2]
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), due - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def reschedule(self, address, reading=None):
+        """ Schedules the next state poll of address after its poll has finished
+
+        reading is a tuple of the reported power and state, or None if the
+        inverter did not answer.
+        """
+        if address in self.removed:
+            return
+
+        settings = self.get_settings(address)
+        interval = self.intervals[address]
+
+        if reading is None:
+            self.failures[address] = self.failures.get(address, 0) + 1
+            interval = min(max(interval, settings.interval) * settings.backoff, settings.max_interval)
+        else:
+            self.failures[address] = 0
+            last = self.readings.get(address)
+            self.readings[address] = reading
+            power, state = reading
+
+            if not power and (last is None or not last[0]):
+                interval = settings.night_interval
+            elif last is not None and self.changed(last, reading, settings.change_threshold):
+                interval = max(min(interval, settings.interval) / 2, settings.min_interval)
+            else:
+                interval = min(interval * 1.5, settings.interval) if interval < settings.interval \
+                    else settings.interval
+
+        self.intervals[address] = interval
+        self.schedule((address, QUERY_STATE), time.monotonic() + interval)
+
+        self.state_polls[address] = self.state_polls.get(address, 0) + 1
+        if self.settings_every and self.state_polls[address] % self.settings_every == 0:
+            self.request_settings(address)
+
+    @staticmethod
+    def changed(last, reading, threshold):
+        last_power, last_state = last
+        power, state = reading
+        if state != last_state:
+            return True
+        if last_power is None or power is None:
+            return last_power != power
+        return abs(power - last_power) > threshold * max(abs(last_power), 1)
@@ -0,0 +1,101 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SMI260Shards:
+    """ Assigns the inverters of the fleet to the sticks which poll them
+
+    Inverters can be assigned to a stick by hand. All other inverters are
+    polled by every stick until each stick has tried once. Then they are
+    assigned to the stick which heard them with the best RSSI; sticks which
+    never heard an inverter rank last. Frames heard by a stick from any
+    inverter count, so a stick also learns from the answers to the queries
+    of the other sticks. An inverter no stick has heard after unheard_polls
+    polls is assigned to the sticks round robin, so it does not use the
+    airtime of every stick.
+    """
+
+    def __init__(self, ports, addresses, manual=None, unheard_polls=10):
+        self.ports = list(ports)
+        self.addresses = list(addresses)
+        self.known = frozenset(self.addresses)
+        self.owners = {}
+        self.rssi = {}
+        self.attempts = {}
+        self.unheard_polls = unheard_polls
+        self.unanswered = {}
+        self.next_port = 0
+
+        for port, assigned in (manual or {}).items():
+            if port not in self.ports:
+                raise ValueError("shard of unknown stick " + port)
+            for address in assigned:
+                self.owners[address] = port
+
+    @staticmethod
+    def parse(config):
+        """ Parses manual shards like '/dev/ttyUSB0=1234,2345;/dev/ttyUSB1=7981'
+        """
+        manual = {}
+        for shard in filter(None, config.split(';')):
+            port, addresses = shard.split('=')
+            manual[port.strip()] = [address.strip() for address in addresses.split(',') if address.strip()]
+        return manual
+
+    def owner(self, address):
+        """ Returns the port of the stick an inverter is assigned to, or None
+        """
+        return self.owners.get(address)
+
+    def port_for(self, address):
+        """ Returns the port of the stick to send messages to an inverter
+        """
+        return self.owners.get(address, self.ports[0])
+
+    def addresses_of(self, port):
+        """ Returns the inverters a stick polls, including the unassigned ones
+        """
+        return [address for address in self.addresses if self.owners.get(address, port) == port]
+
+    def heard(self, port, address, rssi):
+        if address not in self.known:
+            return
+
+        samples = self.rssi.setdefault(address, {}).setdefault(port, [0, 0])
+        samples[0] += rssi
+        samples[1] += 1
+
+    def polled(self, port, address):
+        """ Notes that a stick polled an unassigned inverter
+
+        Returns the port the inverter got assigned to once every stick has
+        polled it, otherwise None.
+        """
+        if address in self.owners:
+            return self.owners[address]
+
+        heard = self.rssi.get(address, {})
+        if not heard:
+            self.unanswered[address] = self.unanswered.get(address, 0) + 1
+            if self.unanswered[address] < self.unheard_polls:
+                return None
+
+            self.owners[address] = self.ports[self.next_port % len(self.ports)]
+            self.next_port += 1
+            logger.info("SMI %s not heard after %d polls, assigned to stick %s", address, self.unanswered[address],
+                        self.owners[address])
+            return self.owners[address]
+
+        attempts = self.attempts.setdefault(address, set())
+        attempts.add(port)
+        if len(attempts) < len(self.ports):
+            return None
+
+        def rank(candidate):
+            total, count = heard.get(candidate, (0, 0))
+            return (count > 0, total / count if count else 0)
+
+        self.owners[address] = max(self.ports, key=rank)
+        logger.info("SMI %s assigned to stick %s", address, self.owners[address])
+        return self.owners[address]
@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import math
+import os
+import random
+import time
+import tty
+from IM871 import IM871, IM871Framer, Packet, ControlFieldFlags, EndpointID, DeviceMessageIdentifier, \
+    RadioLinkMessageIdentifier
+from SMI260Commands import SMI260Commands
+from SMI260Logging import setup_logging
+
+logger = logging.getLogger('SMI260Simulator')
+
+# responses of inverter 000000 without values, the length field is included
+STATE_TEMPLATE = bytes.fromhex(
+    '20 08 B4 B0 00 00 00 00 01 02 7A 00 00 00 00 04 03 00 00 00 00 02 2B 00 00 04 6D 00 00 00 00 2F 2F')
+SETTINGS_TEMPLATE = bytes.fromhex(
+    '5C 08 B4 B0 00 00 00 00 01 02 7A 00 00 00 00 02 2B 00 00 01 2B 01 01 2B 01 01 2B 01 01 2B 01 01 2B 01 0D 7F 38 38 '
+    '00 00 00 00 88 13 00 00 00 00 00 00 00 00 00 00 00 FA 00 00 00 00 00 00 00 00 00 00 00 2C 01 00 00 00 00 00 00 '
+    '00 00 00 00 00 00 00 20 01 00 00 00 00 00 00 00 00 00')
+SETTINGS_VALUE = 37  # offset of the 56 byte value of the last settings record
+
+# lengths of the wM-Bus messages the gateway sends, without the length field
+QUERY_STATE_LENGTH = len(SMI260Commands().query_state('1')) - 6
+QUERY_SETTINGS_LENGTH = len(SMI260Commands().query_settings('1')) - 6
+CHANGE_STATE_LENGTH = len(SMI260Commands().change_state('1', 0, 0)) - 6
+
+MODULE_TYPE_IM871A = 0x33
+
+
+def sun_curve(hour, sunrise, sunset):
+    """ Returns the share of the peak power at an hour of the day
+    """
+    if not sunrise < hour < sunset:
+        return 0
+    return math.sin(math.pi * (hour - sunrise) / (sunset - sunrise)) ** 1.5
+
+
+def type_f(moment):
+    """ Encodes a date and time as wM-Bus data type F
+    """
+    year = moment.year % 100
+    return bytes((moment.minute, moment.hour, moment.day | (year & 0x07) << 5, moment.month | (year >> 3) << 4))
+
+
+class VirtualInverter:
+    """ An SMI260 whose output follows the sun curve scaled to its peak power
+    """
+
+    def __init__(self, address, peak, max_power=260, on=1, energy=0, rssi=180):
+        self.address = address
+        self.byte_address = SMI260Commands.byte_from_address(address)
+        self.peak = peak
+        self.max_power = max_power
+        self.on = on
+        self.energy = energy
+        self.rssi = rssi
+        self.access = 0
+        self.updated = None
+        self.share = 0
+        self.current = 0
+
+    def update(self, clock, sunrise, sunset):
+        """ Advances the inverter to the time of clock, in simulated seconds since midnight
+        """
+        self.share = sun_curve(clock / 3600 % 24, sunrise, sunset)
+        power = self.peak * self.share * random.uniform(0.95, 1.05) if self.on else 0
+        self.current = int(min(power, self.max_power))
+        if self.updated is not None and clock > self.updated:
+            self.energy += self.current * (clock - self.updated) / 3600
+        self.updated = clock
+
+    def change_state(self, max_power, on):
+        self.max_power = max_power
+        self.on = on
+
+    def response(self, template):
+        self.access = (self.access + 1) & 0xFF
+        message = bytearray(template)
+        message[4:7] = self.byte_address
+        message[11] = self.access
+        return message
+
+    def state_response(self):
+        message = self.response(STATE_TEMPLATE)
+        message[17:21] = int(self.energy).to_bytes(4, 'little')
+        message[23:25] = self.current.to_bytes(2, 'little')
+        message[27:31] = type_f(datetime.datetime.now())
+        return bytes(message)
+
+    def settings_response(self):
+        message = self.response(SETTINGS_TEMPLATE)
+        message[17:19] = self.max_power.to_bytes(2, 'little')
+
+        value = SETTINGS_VALUE
+        frequency = 5000 + random.randint(-5, 5)
+        message[value + 5:value + 7] = frequency.to_bytes(2, 'little')
+        temperature_dcdc = int(200 + 200 * self.share + random.randint(-5, 5))
+        message[value + 18:value + 20] = temperature_dcdc.to_bytes(2, 'little')
+        temperature_dcac = int(200 + 250 * self.share + random.randint(-5, 5))
+        message[value + 30:value + 32] = temperature_dcac.to_bytes(2, 'little')
+        # the power state doubles as high byte of the DC voltage
+        dc_voltage = int(300 + 80 * self.share) if self.share else random.randint(0, 20)
+        message[value + 45] = max(0, min(dc_voltage - self.on * 256, 255))
+        message[value + 46] = self.on
+        return bytes(message)
+
+
+class IM871Simulator:
+    """ Speaks the HCI protocol of an IM871 stick on a pseudo terminal
+
+    Radio messages to the virtual inverters are confirmed right away and
+    answered after latency plus a random share of jitter seconds. A share of
+    loss of the queries stays unanswered, and with the probability garbage
+    random bytes precede an answer. time_scale speeds up the simulated day
+    which starts at start_hour.
+    """
+
+    def __init__(self, inverters, latency=0.05, jitter=0.05, loss=0.0, garbage=0.0, sunrise=6, sunset=20,
+                 time_scale=1.0, start_hour=None):
+        self.inverters = {bytes(inverter.byte_address): inverter for inverter in inverters}
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.garbage = garbage
+        self.sunrise = sunrise
+        self.sunset = sunset
+        self.time_scale = time_scale
+        now = datetime.datetime.now()
+        self.start_clock = (start_hour if start_hour is not None else now.hour + now.minute / 60) * 3600
+        self.started = time.monotonic()
+        self.stick = IM871()
+        self.framer = IM871Framer(self.stick)
+        self.master = None
+        self.slave = None
+        self.queries = 0
+        self.answered = 0
+        self.lost = 0
+        self.commands = 0
+
+    def clock(self):
+        """ Returns the simulated seconds since midnight
+        """
+        return self.start_clock + (time.monotonic() - self.started) * self.time_scale
+
+    def open(self, link=None):
+        """ Opens the pseudo terminal and returns the path the gateway connects to
+        """
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        path = os.ttyname(self.slave)
+        if link:
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(path, link)
+            path = link
+
+        asyncio.get_event_loop().add_reader(self.master, self.data_ready)
+        return path
+
+    def data_ready(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            return
+
+        for packet in self.framer.feed(data):
+            self.handle(packet)
+
+    def handle(self, packet):
+        if packet.endpoint_id == EndpointID.DEVMGMT_ID and packet.message_id.value & 1:
+            # every request is answered by the response which follows it
+            payload = b'\x00'
+            if packet.message_id == DeviceMessageIdentifier.DEVMGMT_MSG_GET_DEVICEINFO_REQ:
+                payload = bytes((0x00, MODULE_TYPE_IM871A, 0x00, 0x01, 0x00, 0x00, 0x00, 0x00, 0x00))
+            self.write(self.packet(EndpointID.DEVMGMT_ID, DeviceMessageIdentifier(packet.message_id.value + 1),
+                                   payload))
+
+        elif packet.endpoint_id == EndpointID.RADIOLINK_ID and \
+                packet.message_id == RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_REQ:
+            self.write(self.packet(EndpointID.RADIOLINK_ID, RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_RSP,
+                                   b'\x00'))
+            self.radio(bytes(packet.payload))
+
+    def radio(self, message):
+        inverter = self.inverters.get(message[3:6])
+        if inverter is None:
+            return
+
+        if len(message) == CHANGE_STATE_LENGTH:
+            self.commands += 1
+            inverter.change_state(int.from_bytes(message[18:20], 'little'), message[35])
+            return
+
+        self.queries += 1
+        if random.random() < self.loss:
+            self.lost += 1
+            return
+
+        delay = self.latency + random.random() * self.jitter
+        asyncio.get_event_loop().call_later(delay, self.answer, inverter, len(message))
+
+    def answer(self, inverter, length):
+        inverter.update(self.clock(), self.sunrise, self.sunset)
+        if length == QUERY_STATE_LENGTH:
+            message = inverter.state_response()
+        elif length == QUERY_SETTINGS_LENGTH:
+            message = inverter.settings_response()
+        else:
+            return
+
+        if random.random() < self.garbage:
+            self.write(os.urandom(random.randint(1, 16)))
+
+        self.answered += 1
+        self.write(self.packet(EndpointID.RADIOLINK_ID, RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_IND,
+                               message[1:], inverter.rssi))
+
+    def packet(self, endpoint_id, message_id, payload, rssi=None):
+        packet = Packet()
+        packet.control_field = ControlFieldFlags.CRC16Field
+        if rssi is not None:
+            packet.control_field |= ControlFieldFlags.RSSIField
+            packet.rssi = rssi
+        packet.endpoint_id = endpoint_id
+        packet.message_id = message_id
+        packet.payload = payload
+        return self.stick.build(packet)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        asyncio.get_event_loop().remove_reader(self.master)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+def fleet(addresses, peak, seed=None):
+    """ Returns virtual inverters with peak powers and RSSIs scattered around peak
+    """
+    scatter = random.Random(seed)
+    return [VirtualInverter(address, int(peak * scatter.uniform(0.8, 1.2)), rssi=scatter.randint(120, 220))
+            for address in addresses]
+
+
+async def report(simulator, interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("%d queries, %d answered, %d lost, %d commands", simulator.queries, simulator.answered,
+                    simulator.lost, simulator.commands)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates an IM871 stick and a fleet of SMI260 inverters')
+    parser.add_argument('--addresses', help='comma separated addresses of the inverters')
+    parser.add_argument('--fleet', type=int, default=1, help='number of inverters if no addresses are given')
+    parser.add_argument('--first-address', type=int, default=1000, help='address of the first inverter of the fleet')
+    parser.add_argument('--peak', type=int, default=250, help='average peak power of the inverters in W')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds until an inverter answers')
+    parser.add_argument('--jitter', type=float, default=0.05, help='random seconds added to the latency')
+    parser.add_argument('--loss', type=float, default=0.0, help='share of unanswered queries')
+    parser.add_argument('--garbage', type=float, default=0.0, help='share of answers preceded by random bytes')
+    parser.add_argument('--sunrise', type=float, default=6, help='hour of the sunrise')
+    parser.add_argument('--sunset', type=float, default=20, help='hour of the sunset')
+    parser.add_argument('--start-hour', type=float, help='simulated hour at start, default now')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='simulated seconds per second')
+    parser.add_argument('--link', help='symlink to create for the pseudo terminal, e.g. /tmp/ttyIM871')
+    parser.add_argument('--seed', type=int, help='seed of the random fleet')
+    args = parser.parse_args()
+
+    setup_logging(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    if args.addresses:
+        addresses = [address.strip() for address in args.addresses.split(',') if address.strip()]
+    else:
+        addresses = [str(args.first_address + number) for number in range(args.fleet)]
+
+    simulator = IM871Simulator(fleet(addresses, args.peak, args.seed), args.latency, args.jitter, args.loss,
+                               args.garbage, args.sunrise, args.sunset, args.time_scale, args.start_hour)
+    loop = asyncio.get_event_loop()
+    path = simulator.open(args.link)
+    logger.info("simulating %d inverters %s..%s on %s", len(addresses), addresses[0], addresses[-1], path)
+    loop.create_task(report(simulator, 60))
+    try:
+        loop.run_forever()
+    finally:
+        simulator.close()
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+
+
+if __name__ == "__main__":
+    main()
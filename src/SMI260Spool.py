@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SMI260Spool:
+    """ Append-only spool on disk for messages which could not be published
+
+    Messages are appended as lines of timestamp, key and payload to segment
+    files in directory. A new segment is started once the current one holds
+    max_size / segments bytes and the oldest segments are deleted while the
+    spool holds more than max_size bytes. Messages older than max_age seconds
+    are dropped. replay publishes the messages in the order they were
+    appended and deletes every segment after it was published completely.
+
+    The files are written, synced and read by a single writer thread, so the
+    event loop does not wait for the disk and the writes keep their order.
+    The size of every segment is kept in memory.
+    """
+
+    SUFFIX = '.spool'
+
+    def __init__(self, directory, max_size=10 * 1024 * 1024, max_age=7 * 24 * 3600, segments=8):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.segment_size = max(max_size // segments, 1)
+        self.current = None
+        self.file = None
+        self.position = None
+        self.appended = asyncio.Event()
+        self.writer = ThreadPoolExecutor(1, 'SMI260Spool')
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        os.makedirs(directory, exist_ok=True)
+        # bytes and messages of every segment by name, oldest first
+        self.sizes = {}
+        for name in sorted(name for name in os.listdir(directory) if name.endswith(self.SUFFIX)):
+            with open(os.path.join(directory, name), 'rb') as segment:
+                data = segment.read()
+            self.sizes[name] = [len(data), data.count(b'\n')]
+        self.total = sum(size for size, _ in self.sizes.values())
+        self.counter = int(max(self.sizes)[:-len(self.SUFFIX)]) + 1 if self.sizes else 0
+
+    def segments(self):
+        """ Returns the names of the segment files, oldest first
+        """
+        return list(self.sizes)
+
+    def size(self):
+        return self.total
+
+    def empty(self):
+        return not self.sizes
+
+    def append(self, key, payload, timestamp):
+        if self.current is None or self.sizes[self.current][0] >= self.segment_size:
+            self.current = "%012d%s" % (self.counter, self.SUFFIX)
+            self.counter += 1
+            self.sizes[self.current] = [0, 0]
+
+        line = ("%.3f %s %s\n" % (timestamp, key, payload)).encode()
+        self.writer.submit(self.write, self.current, line)
+        self.sizes[self.current][0] += len(line)
+        self.sizes[self.current][1] += 1
+        self.total += len(line)
+        self.spooled += 1
+        self.appended.set()
+        self.trim()
+
+    def write(self, name, line):
+        """ Appends line to the segment name and syncs it, runs on the writer thread
+        """
+        path = os.path.join(self.directory, name)
+        if self.file is None or self.file.name != path:
+            self.close_file()
+            self.file = open(path, 'ab')
+        self.file.write(line)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        """ Closes the current segment, the next message starts a new one
+        """
+        self.current = None
+        self.writer.submit(self.close_file)
+
+    def remove(self, name):
+        """ Forgets the segment name and deletes its file on the writer thread
+        """
+        size, _ = self.sizes.pop(name)
+        self.total -= size
+        if name == self.current:
+            self.close()
+        self.writer.submit(self.remove_file, os.path.join(self.directory, name))
+
+    def remove_file(self, path):
+        if self.file is not None and self.file.name == path:
+            self.close_file()
+        if os.path.exists(path):
+            os.remove(path)
+
+    def trim(self):
+        """ Deletes the oldest segments while the spool is too large
+        """
+        while self.total > self.max_size and len(self.sizes) > 1:
+            name = next(iter(self.sizes))
+            self.dropped += self.sizes[name][1]
+            if self.position is not None and self.position[0] == name:
+                self.position = None
+            self.remove(name)
+
+    def read(self, name, offset):
+        """ Returns the lines of segment name from offset on, runs on the writer thread
+        """
+        with open(os.path.join(self.directory, name), 'rb') as segment:
+            segment.seek(offset)
+            return segment.readlines()
+
+    async def replay(self, publish, connected, rate=10.0):
+        """ Publishes the spooled messages at no more than rate messages per second
+
+        publish is called with the key, the payload and the timestamp of every
+        message. Returns once the spool is empty or connected() returns false;
+        the next replay continues with the first message not yet published.
+        """
+        loop = asyncio.get_event_loop()
+        self.close()
+        self.appended.clear()
+
+        for name in self.segments():
+            offset = self.position[1] if self.position is not None and self.position[0] == name else 0
+            lines = await loop.run_in_executor(self.writer, self.read, name, offset)
+            for line in lines:
+                if name not in self.sizes:
+                    break  # trimmed while it was replayed
+                if not connected():
+                    self.position = (name, offset)
+                    return
+
+                offset += len(line)
+                timestamp, key, payload = line.decode().rstrip('\n').split(' ', 2)
+                if time.time() - float(timestamp) > self.max_age:
+                    self.dropped += 1
+                    continue
+
+                publish(key, payload, float(timestamp))
+                self.replayed += 1
+                await asyncio.sleep(1.0 / rate)
+
+            self.position = None
+            if name in self.sizes:
+                self.remove(name)
@@ -5,7 +5,7 @@ import serial
 
 parser = argparse.ArgumentParser(description='Sends commands to SMI260 inverter')
 parser.add_argument('--port', help='port of the wireless mbus stick', required=True)
-parser.add_argument('--address', help='address of the inverter', required=True)
+parser.add_argument('--address', help='address of the inverter, or a comma separated list of addresses', required=True)
 parser.add_argument('--maxPower', type=int, help='maximum power output', required=True)
 parser.add_argument('--power', help='switch inverter on or off', choices=['on', 'off'], required=True)
 
@@ -21,8 +21,10 @@ except serial.serialutil.SerialException as ex:
     exit(1)
 
 cmd = SMI260Commands()
-smimsg = cmd.change_state(args.address, args.maxPower, 1 if args.power == 'on' else 0)
-ser.write(smimsg)
+target = (args.maxPower, 1 if args.power == 'on' else 0)
+commands = cmd.change_state_bulk({address.strip(): target for address in args.address.split(',') if address.strip()})
+for smimsg in commands.values():
+    ser.write(smimsg)
 ser.flush()
 ser.close()
 
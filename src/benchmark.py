@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import timeit
+from IM871 import IM871, IM871Framer, Packet, ControlFieldFlags, EndpointID, RadioLinkMessageIdentifier
+from SMI260Commands import SMI260Commands
+from wmbus import WMBusFrame, WMBusLayoutCache
+
+# synthetic responses of inverter 7981 to query_state and query_settings
+STATE_SAMPLE = bytes.fromhex(
+    '20 08 B4 B0 81 79 00 00 01 02 7A 01 00 00 00 04 03 40 E2 01 00 02 2B B4 00 04 6D 01 02 03 04 2F 2F')
+SETTINGS_SAMPLE = bytes.fromhex(
+    '5C 08 B4 B0 81 79 00 00 01 02 7A 01 00 00 00 02 2B 04 01 01 2B 01 01 2B 01 01 2B 01 01 2B 01 01 2B 01 0D 7F 38 38 '
+    '00 00 00 00 88 13 00 00 00 00 00 00 00 00 00 00 00 FA 00 00 00 00 00 00 00 00 00 00 00 2C 01 00 00 00 00 00 00 '
+    '00 00 00 00 00 00 00 20 01 00 00 00 00 00 00 00 00 00')
+
+
+def check_crc16(stick, samples):
+    """ Ensures that the table driven crc16 matches the bitwise reference
+    """
+    for sample in samples:
+        if stick.crc16(sample) != stick.crc16_bitwise(sample):
+            raise Exception("crc16 mismatch for " + sample.hex())
+
+    frames = [SMI260Commands().change_state('7981', 260, 1)]
+    corrupted = bytearray(frames[0])
+    corrupted[5] ^= 0x01
+    frames.append(corrupted)
+    if stick.verify_crcs(frames) != [True, False]:
+        raise Exception("verify_crcs does not detect corrupted packets")
+
+
+def bench_crc16(number):
+    stick = IM871()
+    samples = [os.urandom(length) for length in range(256)]
+    check_crc16(stick, samples)
+
+    packet = os.urandom(40)
+    results = {
+        "crc16": timeit.timeit(lambda: stick.crc16(packet), number=number),
+        "crc16_bitwise": timeit.timeit(lambda: stick.crc16_bitwise(packet), number=number),
+    }
+
+    frames = [SMI260Commands().query_settings('7981')] * number
+    results["verify_crcs"] = timeit.timeit(lambda: stick.verify_crcs(frames), number=1)
+    return results
+
+
+def indication(message):
+    """ Returns the IM871 packet the stick sends for a received wM-Bus message
+    """
+    packet = Packet()
+    packet.control_field = ControlFieldFlags.CRC16Field | ControlFieldFlags.RSSIField
+    packet.endpoint_id = EndpointID.RADIOLINK_ID
+    packet.message_id = RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_IND
+    packet.payload = message[1:]
+    packet.rssi = 180
+    return bytes(IM871().build(packet))
+
+
+def bench_im871(number):
+    stick = IM871()
+    packets = [indication(STATE_SAMPLE), indication(SETTINGS_SAMPLE)]
+    for packet, sample in zip(packets, (STATE_SAMPLE, SETTINGS_SAMPLE)):
+        parsed = stick.parse(packet)
+        if len(parsed) != 1 or bytes(stick.get_wmbus_message(parsed[0])) != sample:
+            raise Exception("IM871.parse does not return the message built into " + packet.hex())
+
+    # a stream of 32 packets split into reads of 64 bytes, fed number // 32 times
+    stream = b''.join(packets) * 16
+    chunks = [stream[start:start + 64] for start in range(0, len(stream), 64)]
+
+    def feed():
+        framer = IM871Framer(stick)
+        for chunk in chunks:
+            framer.feed(chunk)
+
+    return {
+        "im871_parse_state": timeit.timeit(lambda: stick.parse(packets[0]), number=number),
+        "im871_parse_settings": timeit.timeit(lambda: stick.parse(packets[1]), number=number),
+        "im871_framer_stream": timeit.timeit(feed, number=max(number // 32, 1)),
+    }
+
+
+def record_values(frame):
+    return [(bytes(record.header.dif), bytes(record.header.vif), bytes(record.value)) for record in frame.records]
+
+
+def check_layout_cache(samples):
+    """ Ensures that frames decoded from the layout cache equal parsed frames
+    """
+    cache = WMBusLayoutCache()
+    for sample in samples * 2:
+        parsed = WMBusFrame()
+        parsed.parse(memoryview(sample))
+        cached = WMBusFrame()
+        cached.parse(memoryview(sample), None, cache)
+        if record_values(parsed) != record_values(cached):
+            raise Exception("layout cache mismatch for " + sample.hex())
+
+    if cache.hits != len(samples):
+        raise Exception("layout cache missed known frames")
+
+
+def bench_wmbus(number):
+    samples = [STATE_SAMPLE, SETTINGS_SAMPLE]
+    check_layout_cache(samples)
+
+    cache = WMBusLayoutCache()
+    results = {}
+    for name, sample in (("state", STATE_SAMPLE), ("settings", SETTINGS_SAMPLE)):
+        view = memoryview(sample)
+        results["wmbus_" + name] = timeit.timeit(lambda: WMBusFrame().parse(view), number=number)
+        results["wmbus_" + name + "_cached"] = timeit.timeit(lambda: WMBusFrame().parse(view, None, cache),
+                                                             number=number)
+        results["wmbus_" + name + "_lazy"] = timeit.timeit(lambda: WMBusFrame().parse(view, None, cache, True),
+                                                           number=number)
+    return results
+
+
+def bench_commands(number):
+    fleet = {str(100000 + index): (260, 1) for index in range(number)}
+    commands = SMI260Commands()
+    return {
+        "change_state": timeit.timeit(lambda: SMI260Commands().change_state('7981', 260, 1), number=number),
+        "change_state_cached": timeit.timeit(lambda: commands.change_state('7981', 260, 1), number=number),
+        "change_state_bulk": timeit.timeit(lambda: commands.change_state_bulk(fleet), number=1),
+        "query_state_cached": timeit.timeit(lambda: commands.query_state('7981'), number=number),
+    }
+
+
+BENCHMARKS = {
+    "commands": bench_commands,
+    "crc16": bench_crc16,
+    "im871": bench_im871,
+    "wmbus": bench_wmbus,
+}
+
+
+def run(names, number):
+    """ Runs benchmarks and returns the microseconds per operation by key
+    """
+    results = {}
+    for name in names or sorted(BENCHMARKS):
+        for key, duration in BENCHMARKS[name](number).items():
+            results[key] = duration / number * 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs micro benchmarks of the gateway')
+    parser.add_argument('--number', type=int, default=10000, help='iterations per benchmark')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run: ' + ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    results = run(args.benchmarks, args.number)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, microseconds in results.items():
+            print("%-20s %10.3f us/op" % (key, microseconds))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import paho.mqtt.client as mqtt
+import benchmark
+
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SMI260Simulator.py')
+FIRST_ADDRESS = 100000
+
+# settings of the gateway for the benchmark, the environment overrides them. Every inverter is polled again as
+# soon as it answered, so a poll cycle takes as long as the serial link and the transmitter need for the fleet.
+GATEWAY_SETTINGS = {
+    'POLL': '0',
+    'POLL_MIN': '0',
+    'POLL_NIGHT': '0',
+    'MAX_QUERY_RATE': '1000',
+    'MAX_OUTSTANDING': '16',
+    'DUTY_CYCLE': '1',
+    'SETTINGS_EVERY': '0',
+    'QUERY_TIMEOUT': '3',
+    'LOG_LEVEL': 'WARNING',
+}
+
+
+class MQTTStandIn:
+    """ Minimal MQTT 3.1.1 broker for the benchmark
+
+    Accepts any client, delivers QoS 0 messages to the subscribers of their
+    topic and counts the messages published to it. Clients publishing with
+    a higher QoS get no acknowledgement.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.clients = {}  # writer -> topic filters with wildcards
+        self.subscribers = {}  # topic -> writers
+        self.published = 0
+        self.subscriptions = 0
+
+    async def start(self, host='127.0.0.1'):
+        self.server = await asyncio.start_server(self.handle, host, 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+        for writer in self.clients:
+            writer.close()
+
+    @staticmethod
+    def string(data, offset):
+        length = int.from_bytes(data[offset:offset + 2], 'big')
+        return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+    @staticmethod
+    def packet(kind, body):
+        header = bytearray((kind,))
+        length = len(body)
+        while True:
+            byte = length & 0x7F
+            length >>= 7
+            header.append(byte | 0x80 if length else byte)
+            if not length:
+                return bytes(header) + body
+
+    async def handle(self, reader, writer):
+        self.clients[writer] = []
+        try:
+            while True:
+                kind = (await reader.readexactly(1))[0]
+                length = 0
+                for shift in range(0, 28, 7):
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7F) << shift
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+
+                if kind >> 4 == 1:  # CONNECT
+                    writer.write(self.packet(0x20, b'\x00\x00'))
+                elif kind >> 4 == 3:  # PUBLISH
+                    self.published += 1
+                    topic, offset = self.string(body, 0)
+                    if kind & 0x06:
+                        offset += 2
+                    self.publish(topic, body[offset:])
+                elif kind >> 4 == 8:  # SUBSCRIBE
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic, offset = self.string(body, offset)
+                        offset += 1
+                        if '+' in topic or '#' in topic:
+                            self.clients[writer].append(topic)
+                        else:
+                            self.subscribers.setdefault(topic, set()).add(writer)
+                        self.subscriptions += 1
+                        granted.append(0)
+                    writer.write(self.packet(0x90, body[0:2] + granted))
+                elif kind >> 4 == 12:  # PINGREQ
+                    writer.write(self.packet(0xD0, b''))
+                elif kind >> 4 == 14:  # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self.clients[writer]
+            for writers in self.subscribers.values():
+                writers.discard(writer)
+            writer.close()
+
+    def publish(self, topic, payload):
+        """ Delivers a message to all clients subscribed to topic
+        """
+        writers = set(self.subscribers.get(topic, ()))
+        writers.update(writer for writer, subscriptions in self.clients.items()
+                       if any(mqtt.topic_matches_sub(subscription, topic) for subscription in subscriptions))
+        if writers:
+            encoded = topic.encode()
+            message = self.packet(0x30, len(encoded).to_bytes(2, 'big') + encoded + payload)
+            for writer in writers:
+                writer.write(message)
+
+
+class WriteProbe:
+    """ Wraps the serial transport and notes when a change_state command is written to the stick
+    """
+
+    def __init__(self, transport, length):
+        self.transport = transport
+        self.length = length
+        self.written = {}
+
+    def write(self, data):
+        self.transport.write(data)
+        if len(data) == self.length:
+            future = self.written.get(bytes(data[7:10]))
+            if future is not None and not future.done():
+                future.set_result(time.monotonic())
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+def rss_kb():
+    """ Returns the resident set size of the process in kB, or its peak where it is not available
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "min": values[0],
+        "median": statistics.median(values),
+        "p95": values[min(int(len(values) * 0.95), len(values) - 1)],
+        "max": values[-1],
+    }
+
+
+async def run_fleet(args, link):
+    """ Runs the gateway against a simulated fleet and returns its measurements
+    """
+    import serial_asyncio
+    import SMI260MQTTGateway as gateway
+    from SMI260Commands import SMI260Commands
+
+    loop = asyncio.get_event_loop()
+    broker = MQTTStandIn()
+    await broker.start()
+
+    addresses = [str(FIRST_ADDRESS + number) for number in range(args.fleet)]
+    os.environ.update({'SUNSTICKPORT': link, 'SMI_LIST': ','.join(addresses), 'MQTTSERVER': '127.0.0.1',
+                       'MQTTSERVERPORT': str(broker.port)})
+    for name, value in GATEWAY_SETTINGS.items():
+        os.environ.setdefault(name, value)
+    gateway.setup_logging_from_env()
+
+    simulator = subprocess.Popen([sys.executable, SIMULATOR, '--fleet', str(args.fleet), '--first-address',
+                                  str(FIRST_ADDRESS), '--latency', str(args.latency), '--jitter', str(args.jitter),
+                                  '--start-hour', '12', '--seed', '1', '--link', link],
+                                 env=dict(os.environ, LOG_LEVEL='WARNING'))
+    try:
+        while not os.path.exists(link):
+            if simulator.poll() is not None:
+                raise Exception("simulator exited with %d" % simulator.returncode)
+            await asyncio.sleep(0.01)
+
+        state = gateway.build_state([link])
+        state.loop = loop
+        loop.create_task(gateway.mqtt_task(state))
+        while broker.subscriptions < 3 * len(addresses):
+            await asyncio.sleep(0.01)
+
+        started = time.monotonic()
+        cpu_started = cpu_seconds()
+        rss_started = rss_kb()
+        await serial_asyncio.create_serial_connection(loop, lambda: gateway.Communication(state, link), link,
+                                                      baudrate=57600)
+        while link not in state.sticks:
+            await asyncio.sleep(0.001)
+        stick = state.sticks[link]
+        probe = WriteProbe(stick.transmitter.transport, len(SMI260Commands().change_state(addresses[0], 0, 0)))
+        stick.transmitter.transport = probe
+
+        # a cycle is complete once every inverter has answered one more state query
+        readings = [gateway.READINGS.labels(address, 'state') for address in addresses]
+        cycles = []
+        last = started
+        deadline = started + args.timeout
+        while len(cycles) < args.cycles and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)
+            if min(reading.value for reading in readings) > len(cycles):
+                now = time.monotonic()
+                cycles.append(now - last)
+                last = now
+
+        # set commands are sent one at a time to different inverters to measure them without queueing
+        latencies = []
+        for number, address in enumerate(addresses[:args.commands]):
+            written = probe.written[bytes(SMI260Commands.byte_from_address(address))] = loop.create_future()
+            published = time.monotonic()
+            broker.publish(gateway.build_mqtt_topic(address, 'MaxPower/Set'), str(100 + number % 150).encode())
+            try:
+                latencies.append((await asyncio.wait_for(written, 5) - published) * 1000)
+            except asyncio.TimeoutError:
+                pass
+
+        elapsed = time.monotonic() - started
+        frames = gateway.FRAMES.labels(link).value
+        cpu = cpu_seconds() - cpu_started
+        rss = rss_kb()
+        per_1000 = 1000 / frames if frames else 0
+        result = {
+            "fleet": args.fleet,
+            "cycles": cycles,
+            "first_cycle_seconds": cycles[0] if cycles else None,
+            "cycle_seconds": statistics.mean(cycles[1:]) if len(cycles) > 1 else None,
+            "frames": frames,
+            "seconds": elapsed,
+            "frames_per_second": frames / elapsed,
+            "decode_frames_per_second": gateway.DECODE_SECONDS.count / gateway.DECODE_SECONDS.sum
+            if gateway.DECODE_SECONDS.sum else None,
+            "query_timeouts": sum(child.value for child in gateway.QUERY_TIMEOUTS.children.values()),
+            "command_latency_ms": percentiles(latencies),
+            "commands_lost": min(args.commands, len(addresses)) - len(latencies),
+            "mqtt_messages": broker.published,
+            "cpu_seconds_per_1000_frames": cpu * per_1000,
+            "rss_kb": rss,
+            "rss_kb_per_1000_frames": (rss - rss_started) * per_1000,
+        }
+
+        # stop polling before the simulator goes away
+        stick.transmitter.pause()
+        stick.transport.pause_reading()
+        gateway.mqtt_client.disconnect()
+        gateway.mqtt_client.loop_stop()
+        while broker.clients:
+            await asyncio.sleep(0.01)
+        broker.close()
+
+        # a cancellation arriving together with a timeout of wait_for may get lost, so cancel until all are done
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        while tasks:
+            for task in tasks:
+                task.cancel()
+            tasks = (await asyncio.wait(tasks, timeout=0.1))[1]
+        return result
+    finally:
+        simulator.terminate()
+        simulator.wait()
+
+
+def fleet_options(args):
+    return ['--latency', str(args.latency), '--jitter', str(args.jitter), '--cycles', str(args.cycles),
+            '--commands', str(args.commands), '--timeout', str(args.timeout)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the gateway against a simulated stick and fleet')
+    parser.add_argument('--fleets', default='10,100,1000', help='comma separated fleet sizes to benchmark')
+    parser.add_argument('--cycles', type=int, default=3, help='poll cycles to measure per fleet size')
+    parser.add_argument('--commands', type=int, default=50, help='set commands to measure per fleet size')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds until a simulated inverter answers')
+    parser.add_argument('--jitter', type=float, default=0.02, help='random seconds added to the latency')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for the poll cycles')
+    parser.add_argument('--number', type=int, default=10000, help='iterations per micro benchmark, 0 skips them')
+    parser.add_argument('--output', help='file to write the JSON results to instead of stdout')
+    parser.add_argument('--fleet', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fleet:
+        # every fleet size runs in its own process to measure its CPU and memory alone
+        with tempfile.TemporaryDirectory() as directory:
+            result = asyncio.get_event_loop().run_until_complete(
+                run_fleet(args, os.path.join(directory, 'ttyIM871')))
+        print(json.dumps(result))
+        return
+
+    results = {
+        "timestamp": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "micro": benchmark.run([], args.number) if args.number else {},
+        "gateway": [],
+    }
+    for fleet in args.fleets.split(','):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--fleet', fleet] + fleet_options(args),
+                                stdout=subprocess.PIPE, check=True).stdout
+        results["gateway"].append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    document = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(document + '\n')
+    else:
+        print(document)
+
+
+if __name__ == "__main__":
+    main()
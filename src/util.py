@@ -52,7 +52,7 @@ def tohex(v, split=' '):
 	their hexadecimal form separated by the splitter string
 	"""
 	myformat = "%0.2X"
-	if type(v) == array or type(v) == bytearray:
+	if type(v) in (array, bytearray, bytes, memoryview):
 		return split.join(myformat % x for x in v)
 	elif type(v) == str:
 		temp = bytearray(v)
@@ -61,3 +61,19 @@ def tohex(v, split=' '):
 		return myformat % v
 	else:
 		return "tohex(): unsupported type"
+
+
+class HexDump:
+	""" Formats data in hex form only when it is converted to a string.
+	
+	Pass it as argument of a log message, so the hex form is only built if
+	the message is actually logged.
+	"""
+	
+	__slots__ = ('data',)
+	
+	def __init__(self, data):
+		self.data = data
+	
+	def __str__(self):
+		return tohex(self.data)
@@ -1,12 +1,19 @@
 # -*- coding: utf-8 -*-
 
-import sys, util, os
+import sys, util, logging
 
 from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
 from datetime import datetime
 from Crypto.Cipher import AES
+from SMI260Metrics import counter
 
-debug = os.getenv('DEBUG', False)
+logger = logging.getLogger(__name__)
+
+FRAMES = counter('wmbus_frames_total', 'wM-Bus frames parsed')
+INVALID_FRAMES = counter('wmbus_invalid_frames_total', 'wM-Bus frames rejected because of their length')
+LENGTH_MISMATCHES = counter('wmbus_length_mismatches_total', 'wM-Bus frames whose length field does not match')
 
 
 class WMBusFrame:
@@ -25,7 +32,7 @@ class WMBusFrame:
         self.data_size = None
         self.key = None
 
-    def parse(self, arr, keys=None):
+    def parse(self, arr, keys=None, layout_cache=None, lazy=False):
         """ Parses frame contents and initializes object values
         
         The first steps of setting up an WMBusFrame should be the 
@@ -39,15 +46,25 @@ class WMBusFrame:
             '\x57\x00\x00\x44': '\xCA\xFE\xBA\xBE\x12\x34\x56\x78\x9A\xBC\xDE\xF0\xCA\xFE\xBA\xBE',
             '\x00\x00\x00\x00': '\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF\xFF'
         }
+
+        If a WMBusLayoutCache is passed as layout_cache, the data records of
+        frames with a known layout are sliced directly from the cached value
+        offsets instead of being parsed record by record.
+
+        With lazy set to True only the link layer and transport header are
+        decoded right away. The records become a WMBusRecordList which decodes
+        a record when it is accessed for the first time. A frame missing the
+        layout_cache is still parsed completely, so its layout is cached for
+        the next frames of the same shape.
         """
 
         if len(arr) - 1 != arr[0]:
-            print("WARNING: frame length field does not match effective frame length! Decoding might be unreliable. Check your input.")
-
-            print("frame[0]: ", arr[0])
-            print("len(frame)-1: ", len(arr) - 1)
+            logger.warning("frame length field %d does not match effective frame length %d! Decoding might be "
+                           "unreliable. Check your input.", arr[0], len(arr) - 1)
+            LENGTH_MISMATCHES.inc()
 
         if arr is not None and arr[0] >= 11:
+            FRAMES.inc()
             self.length = arr[0]
             self.control = arr[1]
             self.manufacturer = arr[2:4]
@@ -91,27 +108,63 @@ class WMBusFrame:
                     spec = AES.new(self.key, AES.MODE_CBC, "%s" % self.get_iv())
                     self.data = bytearray(spec.decrypt("%s" % self.data))
 
-                    if debug:
-                        print("dec: ", util.tohex(self.data))
+                    logger.debug("dec: %s", util.HexDump(self.data))
 
                     # check whether the first two bytes are 2F
                     if (self.data[0:2] != '\x2F\x2F'):
-                        print(util.tohex(self.data))
+                        logger.error("decrypted frame: %s", util.HexDump(self.data))
                         raise Exception("Decryption failed")
 
-            self.data = bytearray(self.data.lstrip(bytes([0x2F])).rstrip(bytes([0x2F])))
-
-            if debug:
-                print("cut: ", util.tohex(self.data))
-
-            while len(self.data) > 0:
-                record = WMBusDataRecord()
-                self.data = record.parse(self.data)
-                self.records.append(record)
+            self.data = self.strip_fillers(self.data)
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("cut: %s", util.HexDump(self.data))
+
+            key = None
+            layout = None
+            if layout_cache is not None:
+                key = (bytes(self.manufacturer), bytes(self.address), self.control_information, len(self.data))
+                layout = layout_cache.get(key, self.data)
+
+            if layout is None and layout_cache is not None:
+                self.parse_records()
+                layout_cache.put(key, WMBusRecordLayout(self.data, self.records))
+            elif lazy:
+                self.records = WMBusRecordList(self.data, layout)
+            elif layout is not None:
+                self.records = layout.records(self.data)
+            else:
+                self.parse_records()
         else:
-            print("(%d) " % arr[0] + util.tohex(arr))
+            logger.error("(%d) %s", arr[0], util.HexDump(arr))
+            INVALID_FRAMES.inc()
             raise Exception("Invalid frame length")
 
+    def parse_records(self):
+        """ Parses all data records of the frame one after another
+        """
+        data = self.data
+        while len(data) > 0:
+            record = WMBusDataRecord()
+            data = record.parse(data)
+            self.records.append(record)
+
+    @staticmethod
+    def strip_fillers(arr):
+        """ Returns arr without leading and trailing 0x2F idle filler bytes
+
+        The method only slices arr, so memoryviews are not copied.
+        """
+        start = 0
+        stop = len(arr)
+
+        while start < stop and arr[start] == 0x2F:
+            start += 1
+        while stop > start and arr[stop - 1] == 0x2F:
+            stop -= 1
+
+        return arr[start:stop]
+
     def get_manufacturer_short(self):
         """ Returns the three letter manufacturer code
         
@@ -156,7 +209,7 @@ class WMBusFrame:
         return self.address[4]
 
     def log(self, verb):
-        """ Print a log record for that frame
+        """ Log a record for that frame
         
         The log record consist of the following information
         - timestamp
@@ -207,8 +260,7 @@ class WMBusFrame:
 
                 if verb >= 2:
                     for rec in self.records:
-                        val = rec.value
-                        val.reverse()
+                        val = rec.value[::-1]
                         line += '\nDIFs:\t' + util.tohex(rec.header.dif)
                         line += " (" + rec.header.get_function_field_name()
                         line += ", " + rec.header.get_data_field_name() + ")"
@@ -218,14 +270,13 @@ class WMBusFrame:
 
                         line += '\nValue:\t' + util.tohex(val)
                         line += '\n--'
-                        val.reverse()  # caused by ref :(
         else:
             line += 'Data: ' + util.tohex(self.data)
         '''
         line += "v%0.3d" % self.get_device_version() + " "
         line += self.get_device_type() + " (" + util.tohex(self.address[5]) + ") "
         '''
-        print(line)
+        logger.info(line)
 
     def is_without_tl(self):
         """ Returns True if the CI field indicates no transport layer
@@ -479,7 +530,7 @@ class WMBusShortDataHeader():
         """
         self.access_nr = arr[0]
         self.status = arr[1]
-        self.configuration = arr[2:4]
+        self.configuration = bytearray(arr[2:4])
 
         # swap configuration bytes as these arrive little endian
         swap = self.configuration[0]
@@ -1192,3 +1243,135 @@ class WMBusDataRecord:
             0x06: 0.001,  # Energy kWh
             0x07: 0.00001,  # Energy 10⁴ Wh
         }.get(chooser)
+
+
+class WMBusRecordLayout:
+    """ Holds the positions of the data records within the data of a frame
+
+    For every record the layout stores its DIF and VIF bytes, the bytes its
+    structure was derived from (DIFs, VIFs and, for variable length values,
+    the length byte) and the offsets of its value.
+    """
+
+    def __init__(self, data, records):
+        self.entries = []
+        offset = 0
+
+        for record in records:
+            header_length = len(record.header.dif) + len(record.header.vif)
+            start = offset + header_length
+            if record.header.get_data_type() == WMBusDataRecordHeader.DATA_TYPE_VARIABLE:
+                start += 1
+            stop = start + len(record.value)
+            signature_stop = start + 1 if start > offset + header_length else offset + header_length
+
+            self.entries.append((offset, bytes(data[offset:signature_stop]), bytes(record.header.dif),
+                                 bytes(record.header.vif), start, stop))
+            offset = stop
+
+    def matches(self, data):
+        """ Returns True if data has the record structure of this layout
+        """
+        for offset, signature, dif, vif, start, stop in self.entries:
+            if data[offset:offset + len(signature)] != signature:
+                return False
+        return True
+
+    def record(self, data, index):
+        """ Returns the data record at index by slicing the cached offsets
+        """
+        offset, signature, dif, vif, start, stop = self.entries[index]
+        record = WMBusDataRecord()
+        record.header.dif = dif
+        record.header.vif = vif
+        record.value = data[start:stop]
+        return record
+
+    def records(self, data):
+        """ Returns all data records of data
+        """
+        return [self.record(data, index) for index in range(len(self.entries))]
+
+
+class WMBusRecordList(Sequence):
+    """ Sequence of data records which are decoded on first access
+
+    Records are sliced from the layout if one is known. Otherwise they are
+    parsed one after another up to the requested index.
+    """
+
+    def __init__(self, data, layout=None):
+        self.data = data
+        self.layout = layout
+        self.decoded = []
+        self.remaining = data
+
+    def decode(self, index):
+        """ Decodes the records up to index, returns False if there are fewer
+        """
+        decoded = self.decoded
+        if self.layout is not None:
+            entries = len(self.layout.entries)
+            while len(decoded) <= index and len(decoded) < entries:
+                decoded.append(self.layout.record(self.data, len(decoded)))
+            return index < len(decoded)
+
+        while len(decoded) <= index and len(self.remaining) > 0:
+            record = WMBusDataRecord()
+            self.remaining = record.parse(self.remaining)
+            decoded.append(record)
+
+        return index < len(decoded)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            self.decode(sys.maxsize)
+            return self.decoded[index]
+
+        if not self.decode(index):
+            raise IndexError("record index out of range")
+        return self.decoded[index]
+
+    def __len__(self):
+        self.decode(sys.maxsize)
+        return len(self.decoded)
+
+    def __iter__(self):
+        index = 0
+        while self.decode(index):
+            yield self.decoded[index]
+            index += 1
+
+
+class WMBusLayoutCache:
+    """ Least recently used cache of the record layouts of known frames
+
+    Layouts are looked up by manufacturer, address, CI and data length and
+    are only used if the DIF/VIF signature of the cached layout matches the
+    data, otherwise the frame has to be parsed again.
+    """
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.layouts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, data):
+        layout = self.layouts.get(key)
+        if layout is None or not layout.matches(data):
+            self.misses += 1
+            return None
+
+        self.layouts.move_to_end(key)
+        self.hits += 1
+        return layout
+
+    def put(self, key, layout):
+        self.layouts[key] = layout
+        self.layouts.move_to_end(key)
+        if len(self.layouts) > self.max_size:
+            self.layouts.popitem(last=False)
+
+    def clear(self):
+        self.layouts.clear()
@@ -0,0 +1,62 @@
+""" Sample frames and helpers shared by the tests
+"""
+import asyncio
+from IM871 import IM871, Packet, ControlFieldFlags, EndpointID, RadioLinkMessageIdentifier
+
+# responses of inverter 7981 to query_state and query_settings
+STATE = bytes.fromhex('20 08 B4 B0 81 79 00 00 01 02 7A 01 00 00 00 04 03 40 E2 01 00 02 2B B4 00 04 6D 01 02 03 04 '
+                      '2F 2F')
+SETTINGS = bytes.fromhex(
+    '5C 08 B4 B0 81 79 00 00 01 02 7A 01 00 00 00 02 2B 04 01 01 2B 01 01 2B 01 01 2B 01 01 2B 01 01 2B 01 0D 7F 38 38 '
+    '00 00 00 00 88 13 00 00 00 00 00 00 00 00 00 00 00 FA 00 00 00 00 00 00 00 00 00 00 00 2C 01 00 00 00 00 00 00 '
+    '00 00 00 00 00 00 00 20 01 00 00 00 00 00 00 00 00 00')
+
+
+def with_address(sample, address):
+    frame = bytearray(sample)
+    frame[4:7] = address
+    return bytes(frame)
+
+
+def with_power(sample, power):
+    frame = bytearray(sample)
+    frame[23:25] = power.to_bytes(2, 'little')
+    return bytes(frame)
+
+
+def indication(message=STATE, rssi=180):
+    """ Returns the IM871 packet the stick sends for a received wM-Bus message
+    """
+    packet = Packet()
+    packet.control_field = ControlFieldFlags.CRC16Field | ControlFieldFlags.RSSIField
+    packet.endpoint_id = EndpointID.RADIOLINK_ID
+    packet.message_id = RadioLinkMessageIdentifier.RADIOLINK_MSG_WMBUSMSG_IND
+    packet.payload = message[1:]
+    packet.rssi = rssi
+    return bytes(IM871().build(packet))
+
+
+class Datagrams(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.received = []
+
+    def datagram_received(self, data, addr):
+        self.received.append(data)
+
+
+async def udp_listener():
+    """ Returns the transport, the protocol and the port of a local UDP socket collecting the datagrams
+    """
+    transport, listener = await asyncio.get_event_loop().create_datagram_endpoint(
+        Datagrams, local_addr=('127.0.0.1', 0))
+    return transport, listener, transport.get_extra_info('sockname')[1]
+
+
+async def received(listener, count):
+    """ Waits up to a second for count datagrams and returns the datagrams received
+    """
+    for _ in range(100):
+        if len(listener.received) >= count:
+            break
+        await asyncio.sleep(0.01)
+    return listener.received
@@ -0,0 +1,80 @@
+import io
+import json
+from SMI260Archive import SMI260Archive, build, export
+from SMI260Capture import CaptureWriter, RECEIVED
+from helpers import STATE, indication, with_address, with_power
+
+
+def test_export_skips_frames_which_cannot_be_decoded(tmp_path):
+    capture = CaptureWriter(str(tmp_path / 'stick.smicap'))
+    capture.write(RECEIVED, indication(STATE), 1000.0)
+    capture.write(RECEIVED, indication(STATE[:6]), 1001.0)  # cut off within the header
+    capture.write(RECEIVED, indication(STATE[:15] + b'\x2F' * 18), 1002.0)  # a state response without records
+    capture.write(RECEIVED, indication(with_address(STATE, bytes.fromhex('98 79 00'))), 1003.0)
+    capture.close()
+    assert build(str(tmp_path / 'stick.smiarc'), [str(tmp_path / 'stick.smicap')]) == 4
+
+    archive = SMI260Archive(str(tmp_path / 'stick.smiarc'))
+    output = io.StringIO()
+    export(archive, output, None, None, None, 'json')
+    archive.close()
+
+    readings = json.loads(output.getvalue())
+    assert [(reading["Timestamp"], reading["Address"]) for reading in readings] == [(1000.0, '7981'), (1003.0, '7998')]
+    assert readings[0]["Energy"] == 123456
+    assert archive.errors == 2
+
+
+ADDRESSES = {'7981': bytes.fromhex('81 79 00'), '7998': bytes.fromhex('98 79 00'), '1234': bytes.fromhex('34 12 00')}
+
+
+def interleaved_archive(tmp_path, frames=20):
+    """ Archives one capture per inverter whose packets arrive split into two chunks at interleaved times
+    """
+    captures = []
+    for number, (address, byte_address) in enumerate(ADDRESSES.items()):
+        captures.append(str(tmp_path / ('stick%d.smicap' % number)))
+        capture = CaptureWriter(captures[-1])
+        for index in range(frames):
+            packet = indication(with_power(with_address(STATE, byte_address), index))
+            timestamp = 1000 + index + number * 0.25
+            # the first half arrives before the second half of the packet of the previous stick
+            capture.write(RECEIVED, packet[:20], timestamp - 0.3)
+            capture.write(RECEIVED, packet[20:], timestamp)
+        capture.close()
+
+    path = str(tmp_path / 'sticks.smiarc')
+    assert build(path, captures, index_every=4) == frames * len(ADDRESSES)
+    return SMI260Archive(path)
+
+
+def test_archive_merges_interleaved_captures(tmp_path):
+    archive = interleaved_archive(tmp_path)
+    readings = list(archive.readings())
+    archive.close()
+
+    assert len(readings) == 60
+    assert archive.errors == 0
+    assert [reading["Timestamp"] for reading in readings] == sorted(reading["Timestamp"] for reading in readings)
+    assert [(reading["Address"], reading["Power"]) for reading in readings[:4]] == \
+        [('7981', 0), ('7998', 0), ('1234', 0), ('7981', 1)]
+
+
+def test_archive_time_range_seeks_through_the_index(tmp_path):
+    archive = interleaved_archive(tmp_path)
+    readings = list(archive.readings(1005.2, 1007.1))
+    archive.close()
+
+    assert [(reading["Timestamp"], reading["Address"], reading["Power"]) for reading in readings] == [
+        (1005.25, '7998', 5), (1005.5, '1234', 5), (1006.0, '7981', 6), (1006.25, '7998', 6), (1006.5, '1234', 6),
+        (1007.0, '7981', 7)]
+
+
+def test_export_of_an_address(tmp_path):
+    archive = interleaved_archive(tmp_path)
+    output = io.StringIO()
+    export(archive, output, 1010, 1012, '1234', 'json')
+    archive.close()
+
+    assert [(reading["Timestamp"], reading["Address"], reading["Power"]) for reading in json.loads(output.getvalue())] \
+        == [(1010.5, '1234', 10), (1011.5, '1234', 11)]
@@ -0,0 +1,51 @@
+import asyncio
+from SMI260Coalescer import SMI260Coalescer
+
+
+def coalescer(leading_edge=True, window=0.01):
+    sent = []
+    return SMI260Coalescer(lambda address, target, received: sent.append((address, target)), window,
+                           leading_edge), sent
+
+
+def test_report_supersedes_sent_target():
+    async def run():
+        commands, sent = coalescer()
+        commands.confirm('7981', (260, 1))
+        commands.submit('7981', (100, 1), 0)
+        # the inverter reports another state after the command, e.g. it was changed elsewhere
+        commands.confirm('7981', (200, 0))
+        await asyncio.sleep(0.03)
+        return commands, sent
+
+    commands, sent = asyncio.run(run())
+    assert sent == [('7981', (100, 1))]
+    assert commands.target('7981') == (200, 0)
+
+
+def test_report_confirming_pending_target_drops_it():
+    async def run():
+        commands, sent = coalescer(leading_edge=False)
+        commands.confirm('7981', (260, 1))
+        commands.submit('7981', (100, 1), 0)
+        commands.confirm('7981', (100, 1))
+        await asyncio.sleep(0.03)
+        return commands, sent
+
+    commands, sent = asyncio.run(run())
+    assert sent == []
+    assert commands.dropped == 1
+    assert commands.target('7981') == (100, 1)
+
+
+def test_pending_target_newer_than_report_is_sent():
+    async def run():
+        commands, sent = coalescer(leading_edge=False)
+        commands.confirm('7981', (260, 1))
+        commands.submit('7981', (100, 1), 0)
+        commands.confirm('7981', (260, 1))
+        await asyncio.sleep(0.03)
+        return commands, sent
+
+    commands, sent = asyncio.run(run())
+    assert sent == [('7981', (100, 1))]
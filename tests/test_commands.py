@@ -0,0 +1,32 @@
+import pytest
+from IM871 import IM871
+from SMI260Commands import SMI260Commands, CHANGE_STATE_TEMPLATE
+
+TARGETS = {'7981': (260, 1), '100000': (100, 0), '12': (0, 1), '999999': (65535, 0)}
+
+
+def baseline(address, max_power_output, on):
+    """ Builds the command from scratch like before the frames were cached
+    """
+    commands = SMI260Commands()
+    message = commands.set_address(address, bytearray(CHANGE_STATE_TEMPLATE))
+    message[18:20] = max_power_output.to_bytes(2, 'little')
+    message[35] = on
+    return commands.build(message)
+
+
+@pytest.mark.parametrize('address, target', TARGETS.items())
+def test_change_state_matches_baseline(address, target):
+    commands = SMI260Commands()
+    # the second call patches the cached frame of the first
+    assert commands.change_state(address, 260 - target[0] % 260, 1 - target[1]) == \
+        baseline(address, 260 - target[0] % 260, 1 - target[1])
+    assert commands.change_state(address, *target) == baseline(address, *target)
+    assert IM871().verify_crcs([commands.change_state(address, *target)]) == [True]
+
+
+def test_change_state_bulk_matches_baseline():
+    commands = SMI260Commands()
+    commands.change_state('7981', 0, 0)
+    assert commands.change_state_bulk(TARGETS) == {address: baseline(address, *target)
+                                                   for address, target in TARGETS.items()}
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import SMI260MQTTGateway as gateway
+from helpers import STATE, indication, with_address
+
+
+class FailingTransmitter:
+    def __init__(self, error):
+        self.error = error
+        self.sent = 0
+
+    def send(self, message, priority):
+        self.sent += 1
+        future = asyncio.get_event_loop().create_future()
+        if self.error is None:
+            future.set_result(0)
+        else:
+            future.set_exception(self.error)
+        return future
+
+
+def communication(error=None, timeout=0.01):
+    state = gateway.build_state(['stick'])
+    state.query_timeout = timeout
+    stick = gateway.Communication(state, 'stick')
+    stick.transmitter = FailingTransmitter(error)
+    return stick
+
+
+def test_failed_poll_is_logged_and_rescheduled(caplog):
+    async def poll():
+        stick = communication(RuntimeError('stick gone'))
+        await stick.poll_state('7981')
+        await stick.poll_settings('7981', 0)
+        return stick
+
+    stick = asyncio.run(poll())
+    assert stick.pending == {}
+    assert stick.scheduler.failures['7981'] == 1
+    assert '7981' not in stick.scheduler.settings_pending
+    assert [record.message for record in caplog.records if record.exc_info] == \
+        ['state query of SMI 7981 failed', 'settings query of SMI 7981 failed']
+
+
+def test_pending_request_is_removed_on_timeout_and_cancel():
+    async def poll():
+        stick = communication()
+        await stick.poll_state('7981')
+        assert stick.pending == {}
+
+        task = asyncio.ensure_future(stick.query_settings('7981', 10))
+        await asyncio.sleep(0)
+        assert len(stick.pending) == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return stick
+
+    assert asyncio.run(poll()).pending == {}
+
+
+class DisconnectedClient:
+    def __init__(self):
+        self.subscribed = []
+
+    def publish(self, topic, payload):
+        pass  # queued by paho until it drops it on the reconnect
+
+    def subscribe(self, topic):
+        self.subscribed.append(topic)
+
+
+def test_mqtt_backlog_is_reset_on_reconnect(monkeypatch):
+    async def reconnect():
+        state = gateway.build_state(['stick'])
+        state.loop = asyncio.get_event_loop()
+        client = DisconnectedClient()
+        monkeypatch.setattr(gateway, 'mqtt_client', client)
+        gateway.on_connect(client, state, {}, 0)
+        gateway.on_disconnect(client, state, 1)
+        gateway.mqtt_publish('SMI/7981/Power', '120')
+        gateway.mqtt_publish('SMI/7981/Power', '130')
+        backlog = gateway.mqtt_backlog()
+
+        lost = gateway.MQTT_LOST.value
+        gateway.on_connect(client, state, {}, 0)
+        lost = gateway.MQTT_LOST.value - lost
+        gateway.mqtt_publish('SMI/7981/Power', '140')
+        sending = gateway.mqtt_backlog()
+        gateway.on_publish(client, state, 3)
+        return backlog, lost, sending, gateway.mqtt_backlog()
+
+    assert asyncio.run(reconnect()) == (2, 2, 1, 0)
+
+
+def test_reconnect_keeps_known_settings(monkeypatch):
+    async def reconnect():
+        state = gateway.build_state(['stick'])
+        state.loop = asyncio.get_event_loop()
+        client = DisconnectedClient()
+        monkeypatch.setattr(gateway, 'mqtt_client', client)
+        state.device_list['7981']["MaxPower"] = 260
+        gateway.on_connect(client, state, {}, 0)
+        return state, client
+
+    state, client = asyncio.run(reconnect())
+    assert state.device_list['7981']["MaxPower"] == 260
+    assert client.subscribed == ['SMI/7981/MaxPower/Set', 'SMI/7981/PowerOn/Set', 'SMI/7981/Refresh']
+
+
+def test_mqtt_task_survives_unreachable_broker(monkeypatch):
+    async def start():
+        state = gateway.build_state(['stick'])
+        state.loop = asyncio.get_event_loop()
+        server = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        server.close()
+        await server.wait_closed()
+
+        monkeypatch.setenv('MQTTSERVERPORT', str(port))
+        task = asyncio.ensure_future(gateway.mqtt_task(state))
+        await asyncio.sleep(0.2)
+        running = not task.done()
+        task.cancel()
+        gateway.mqtt_client.disconnect()
+        gateway.mqtt_client.loop_stop()
+        return running, state.mqtt_connected.is_set()
+
+    assert asyncio.run(start()) == (True, False)
+
+
+def test_sampled_foreign_frames_are_logged_without_traceback(monkeypatch, caplog):
+    monkeypatch.setenv('FOREIGN_SAMPLE', '1')
+    foreign = with_address(STATE, bytes.fromhex('34 12 00'))
+    broken = bytearray(foreign[:15] + b'\x0C')
+    broken[0] = len(broken) - 1
+
+    async def receive():
+        stick = communication()
+        caplog.set_level(logging.INFO, 'SMI260MQTTGateway')
+        stick.data_received(indication(foreign) + indication(bytes(broken)) + indication(foreign[:11]))
+        return stick
+
+    stick = asyncio.run(receive())
+    foreign_records = [record for record in caplog.records if record.getMessage().startswith('foreign frame')]
+    assert [record.levelno for record in foreign_records] == [logging.INFO] * 3
+    assert not any(record.exc_info for record in caplog.records)
+    assert foreign_records[0].getMessage() == 'foreign frame of LET 00 00 12 34, Electricity, RSSI 180, 3 records'
+    assert 'not decoded' in foreign_records[1].getMessage()
+    assert 'too short' in foreign_records[2].getMessage()
+    assert stick.frames.value == 0
@@ -0,0 +1,72 @@
+import os
+import pytest
+from IM871 import IM871, IM871Framer, SOF
+from helpers import STATE, indication
+
+
+def messages(packets):
+    return [bytes(IM871().get_wmbus_message(packet)) for packet in packets]
+
+
+@pytest.mark.parametrize('data', [b'', b'\x00', b'\xff', b'\xa5', indication()[1:-2], bytes(256), bytes(range(256))] +
+                         [os.urandom(length) for length in (2, 17, 64, 300)])
+def test_crc16_matches_bitwise(data):
+    stick = IM871()
+    assert stick.crc16(data) == stick.crc16_bitwise(data)
+
+
+def test_crc16_of_built_packet():
+    packet = indication()
+    stick = IM871()
+    assert stick.crc16_bitwise(packet[1:-2]) == packet[-2] | packet[-1] << 8
+
+
+def test_verify_crcs():
+    packets = [indication(), indication(rssi=0), indication(bytes((1, 0x44)))]
+    corrupted = bytearray(indication())
+    corrupted[5] ^= 0x01
+    wrong_crc = bytearray(indication())
+    wrong_crc[-1] ^= 0x80
+
+    assert IM871().verify_crcs(packets + [bytes(corrupted), bytes(wrong_crc)]) == [True, True, True, False, False]
+    assert IM871().verify_crcs([]) == []
+
+
+def test_framer_reassembles_split_packets():
+    stream = indication() * 3
+    framer = IM871Framer()
+    packets = []
+    for start in range(0, len(stream), 7):
+        packets.extend(framer.feed(stream[start:start + 7]))
+
+    assert messages(packets) == [STATE] * 3
+    assert [packet.rssi for packet in packets] == [180] * 3
+    assert framer.buffer == b''
+
+
+def test_framer_skips_garbage_between_packets():
+    garbage = bytes((0x00, 0xFF, SOF, 0x12, SOF, 0x10, 0x03, SOF))
+    framer = IM871Framer()
+    packets = framer.feed(garbage + indication() + garbage + indication())
+
+    assert messages(packets) == [STATE] * 2
+    assert framer.discarded > 0
+
+
+def test_framer_skips_corrupted_packet():
+    corrupted = bytearray(indication())
+    corrupted[10] ^= 0x01
+    packets = IM871Framer().feed(bytes(corrupted) + indication())
+
+    assert messages(packets) == [STATE]
+
+
+def test_framer_buffer_stays_bounded_on_garbage():
+    framer = IM871Framer(max_buffer_size=64)
+    # headers announcing long packets which never complete
+    for _ in range(100):
+        framer.feed(bytes((SOF, 0x22, 0x03, 0xFF)) + bytes(range(40)))
+        assert len(framer.buffer) <= 64
+
+    # the stream recovers once a valid packet follows
+    assert messages(framer.feed(indication() * 2)) == [STATE] * 2
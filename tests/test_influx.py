@@ -0,0 +1,84 @@
+import asyncio
+from SMI260InfluxSink import SMI260InfluxSink
+from helpers import udp_listener, received
+
+TIMESTAMP = 1718366400.123
+
+
+async def http_listener(requests):
+    async def handle(reader, writer):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode().split('\r\n')
+        headers = dict(line.split(': ', 1) for line in lines[1:] if line)
+        body = await reader.readexactly(int(headers['Content-Length']))
+        requests.append((lines[0], headers, body))
+        writer.write(b'HTTP/1.1 204 No Content\r\nContent-Length: 0\r\n\r\n')
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_line_protocol_escaping_and_timestamp():
+    async def run():
+        transport, listener, port = await udp_listener()
+        sink = SMI260InfluxSink('udp://127.0.0.1:%d' % port, 'solar power,roof=1')
+        sink.write('79 81,a=b', {"Power": 120, "Frequency": 50.01, "Status": 'ok "x" \\', "On": True}, TIMESTAMP)
+        await sink.close()
+        datagrams = await received(listener, 1)
+        transport.close()
+        return datagrams
+
+    assert asyncio.run(run()) == [
+        b'solar\\ power\\,roof=1,address=79\\ 81\\,a\\=b '
+        b'Power=120i,Frequency=50.01,Status="ok \\"x\\" \\\\",On=true 1718366400123000000\n']
+
+
+def test_udp_batches_fit_batch_size():
+    async def run():
+        transport, listener, port = await udp_listener()
+        sink = SMI260InfluxSink('udp://127.0.0.1:%d' % port, batch_size=100, flush_interval=0.01)
+        task = asyncio.ensure_future(sink.run())
+        for power in range(10):
+            sink.write('7981', {"Power": power}, TIMESTAMP + power)
+        datagrams = await received(listener, 5)
+        task.cancel()
+        await sink.close()
+        transport.close()
+        return sink, datagrams
+
+    sink, datagrams = asyncio.run(run())
+    lines = [line for datagram in datagrams for line in datagram.splitlines()]
+    assert all(len(datagram) <= 100 for datagram in datagrams)
+    assert len(datagrams) == sink.batches == 5
+    assert lines == [b'smi260,address=7981 Power=%di %d' % (power, 1718366400123000000 + power * 10 ** 9)
+                     for power in range(10)]
+
+
+def test_close_flushes_pending_lines_in_one_batch():
+    async def run():
+        requests = []
+        server, port = await http_listener(requests)
+        sink = SMI260InfluxSink('http://127.0.0.1:%d/api/v2/write?org=home&bucket=solar' % port,
+                                flush_interval=60, token='secret')
+        task = asyncio.ensure_future(sink.run())
+        for power in range(3):
+            sink.write('7981', {"Power": power}, TIMESTAMP)
+        await asyncio.sleep(0.01)
+        assert requests == []
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await sink.close()
+        server.close()
+        await server.wait_closed()
+        return sink, requests
+
+    sink, requests = asyncio.run(run())
+    assert len(requests) == 1
+    request, headers, body = requests[0]
+    assert request == 'POST /api/v2/write?org=home&bucket=solar HTTP/1.1'
+    assert headers['Authorization'] == 'Token secret'
+    assert body.splitlines() == [b'smi260,address=7981 Power=%di 1718366400123000000' % power for power in range(3)]
+    assert (sink.pending(), sink.written, sink.batches) == (0, 3, 1)
@@ -0,0 +1,40 @@
+import asyncio
+import os
+import SMI260MQTTGateway as gateway
+from SMI260Capture import CaptureWriter, RECEIVED, WRITTEN
+from SMI260Commands import SMI260Commands
+from SMI260Replay import replay
+from helpers import STATE, indication, udp_listener, received
+
+
+def test_replay_only_decodes_and_leaves_no_tasks(monkeypatch, tmp_path):
+    spool = tmp_path / 'spool'
+    capture = CaptureWriter(str(tmp_path / 'replay-test.smicap'))
+    capture.write(WRITTEN, SMI260Commands().query_state('7981'), 1000.0)
+    capture.write(RECEIVED, indication(STATE), 1000.1)
+    capture.close()
+
+    published = []
+
+    async def run():
+        transport, listener, port = await udp_listener()
+        monkeypatch.setenv('PUBLISH_MODE', 'json')
+        monkeypatch.setenv('SPOOL_DIR', str(spool))
+        monkeypatch.setattr(gateway, 'mqtt_publish', lambda topic, payload: published.append(topic))
+        monkeypatch.setenv('INFLUX_URL', 'udp://127.0.0.1:%d' % port)
+        monkeypatch.setenv('INFLUX_FLUSH_INTERVAL', '60')
+        protocol = await replay(str(tmp_path / 'replay-test.smicap'), 'replay-test', True)
+        left = asyncio.all_tasks() - {asyncio.current_task()}
+        datagrams = await received(listener, 1)
+        transport.close()
+        return protocol, left, datagrams
+
+    protocol, left, datagrams = asyncio.run(run())
+    assert protocol.frames.value == 1
+    assert protocol.transport.written == 0
+    assert protocol.transmitter.queue.qsize() == 0
+    assert left == set()
+    assert published == ['SMI/7981/state']
+    assert not spool.exists() or os.listdir(str(spool)) == []
+    # written with the time of the chunk in the capture
+    assert [line.split(b' ')[1:] for line in datagrams] == [[b'Status=0i,Energy=123456i', b'1000100000000\n']]
@@ -0,0 +1,33 @@
+from SMI260Shards import SMI260Shards
+
+PORTS = ['/dev/ttyUSB0', '/dev/ttyUSB1']
+
+
+def test_heard_inverter_goes_to_best_rssi():
+    shards = SMI260Shards(PORTS, ['7981'])
+    shards.heard(PORTS[0], '7981', 100)
+    shards.heard(PORTS[1], '7981', 150)
+
+    assert shards.polled(PORTS[0], '7981') is None
+    assert shards.polled(PORTS[1], '7981') == PORTS[1]
+    assert shards.addresses_of(PORTS[0]) == []
+
+
+def test_unheard_inverters_are_assigned_round_robin():
+    shards = SMI260Shards(PORTS, ['1', '2', '3'], unheard_polls=4)
+    for address in ('1', '2', '3'):
+        owners = [shards.polled(PORTS[poll % 2], address) for poll in range(4)]
+        assert owners[:3] == [None] * 3
+        assert owners[3] is not None
+
+    assert [shards.owner(address) for address in ('1', '2', '3')] == [PORTS[0], PORTS[1], PORTS[0]]
+    assert shards.addresses_of(PORTS[0]) == ['1', '3']
+    assert shards.addresses_of(PORTS[1]) == ['2']
+
+
+def test_manual_shards_are_kept():
+    shards = SMI260Shards(PORTS, ['1', '2'], SMI260Shards.parse('/dev/ttyUSB1=1'), unheard_polls=1)
+
+    assert shards.polled(PORTS[0], '1') == PORTS[1]
+    assert shards.addresses_of(PORTS[0]) == ['2']
+    assert shards.addresses_of(PORTS[1]) == ['1', '2']
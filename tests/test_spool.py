@@ -0,0 +1,111 @@
+import asyncio
+import os
+import time
+import SMI260MQTTGateway as gateway
+from SMI260Spool import SMI260Spool
+
+NOW = float(int(time.time()))
+
+
+def spooling_gateway(monkeypatch, tmp_path, mode='topics'):
+    monkeypatch.setenv('SPOOL_DIR', str(tmp_path))
+    monkeypatch.setenv('SPOOL_RATE', '1000')
+    monkeypatch.setenv('PUBLISH_MODE', mode)
+    published = []
+    monkeypatch.setattr(gateway, 'mqtt_publish', lambda topic, payload: published.append((topic, payload)))
+    return gateway.build_state(['stick']), published
+
+
+def disk_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+def document(power, timestamp):
+    return '{"Power":%d,"Timestamp":%s}' % (power, timestamp)
+
+
+def test_replay_publishes_state_documents_with_their_timestamp(monkeypatch, tmp_path):
+    async def run():
+        state, published = spooling_gateway(monkeypatch, tmp_path)
+        gateway.publish_reading(state, '7981', {"Power": 120}, NOW)
+        gateway.publish_reading(state, '7981', {"MaxPower": 260}, NOW + 1)
+        assert published == []
+
+        state.mqtt_connected.set()
+        task = asyncio.ensure_future(gateway.spool_task(state))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        return state, published
+
+    state, published = asyncio.run(run())
+    assert published == [
+        ('SMI/7981/state', '{"Power":120,"Timestamp":%s}' % NOW),
+        ('SMI/7981/state', '{"Power":120,"Timestamp":%s,"MaxPower":260}' % (NOW + 1))]
+    assert state.spool.empty()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_live_documents_wait_for_the_replay(monkeypatch, tmp_path):
+    async def run():
+        state, published = spooling_gateway(monkeypatch, tmp_path, 'both')
+        for power in range(3):
+            gateway.publish_reading(state, '7981', {"Power": power}, NOW + power)
+
+        state.mqtt_connected.set()
+        task = asyncio.ensure_future(gateway.spool_task(state))
+        await asyncio.sleep(0)
+        # values go to their own topics right away, the state topic keeps the order of the documents
+        gateway.publish_reading(state, '7981', {"Power": 3}, NOW + 3)
+        await asyncio.sleep(0.1)
+        task.cancel()
+        return published
+
+    published = asyncio.run(run())
+    assert [message for message in published if message[0] == 'SMI/7981/Power'] == [('SMI/7981/Power', '3')]
+    assert [message for message in published if message[0] == 'SMI/7981/state'] == \
+        [('SMI/7981/state', document(power, NOW + power)) for power in range(4)]
+
+
+def test_spool_task_resumes_replay_after_reconnect(monkeypatch, tmp_path):
+    async def run():
+        state, published = spooling_gateway(monkeypatch, tmp_path)
+        for power in range(10):
+            gateway.publish_reading(state, '7981', {"Power": power}, NOW + power)
+
+        state.mqtt_connected.set()
+        task = asyncio.ensure_future(gateway.spool_task(state))
+        while len(published) < 3:
+            await asyncio.sleep(0.001)
+            assert not task.done()
+        state.mqtt_connected.clear()
+        await asyncio.sleep(0.01)
+        interrupted = len(published)
+
+        # nothing is appended after the reconnect, the rest is replayed anyway
+        state.mqtt_connected.set()
+        await asyncio.sleep(0.1)
+        task.cancel()
+        return interrupted, published
+
+    interrupted, published = asyncio.run(run())
+    assert interrupted < 10
+    assert published == [('SMI/7981/state', document(power, NOW + power)) for power in range(10)]
+
+
+def test_trim_drops_oldest_segments_and_tracks_size(tmp_path):
+    async def run():
+        spool = SMI260Spool(str(tmp_path), max_size=400, segments=4)
+        for index in range(20):
+            spool.append('7981', '{"Power":%d}' % index, NOW + index)
+        await asyncio.get_event_loop().run_in_executor(spool.writer, lambda: None)
+        return spool
+
+    spool = asyncio.run(run())
+    assert 0 < spool.size() <= 400
+    assert spool.size() == disk_size(str(tmp_path))
+    assert spool.segments() == sorted(os.listdir(str(tmp_path)))
+    assert spool.dropped + sum(lines for _, lines in spool.sizes.values()) == 20
+
+    reopened = SMI260Spool(str(tmp_path), max_size=400, segments=4)
+    assert reopened.size() == spool.size()
+    assert reopened.counter == spool.counter
@@ -0,0 +1,74 @@
+import asyncio
+from IM871Transmitter import IM871Transmitter, PRIORITY_COMMAND, PRIORITY_POLL
+from SMI260Commands import SMI260Commands
+
+STICK_MESSAGE = bytes.fromhex('A5 81 0F 00 34 13')
+
+
+class Transport:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+
+def transmitter(duty_cycle=1.0):
+    sender = IM871Transmitter(duty_cycle, 1)
+    sender.transport = Transport()
+    return sender
+
+
+def test_pause_holds_message_sent_while_idle():
+    async def run():
+        sender = transmitter()
+        task = asyncio.ensure_future(sender.run())
+        await asyncio.sleep(0)  # run() now waits in queue.get()
+
+        sender.pause()
+        sender.send(STICK_MESSAGE)
+        await asyncio.sleep(0.01)
+        written_while_paused = list(sender.transport.written)
+
+        sender.resume()
+        await asyncio.sleep(0.01)
+        task.cancel()
+        return written_while_paused, sender.transport.written
+
+    paused, written = asyncio.run(run())
+    assert paused == []
+    assert written == [STICK_MESSAGE]
+
+
+def test_command_overtakes_poll_waiting_for_airtime():
+    commands = SMI260Commands()
+    poll = bytes(commands.query_state('7981'))
+    command = bytes(commands.change_state('7981', 100, 1))
+
+    async def run():
+        sender = transmitter(duty_cycle=0.1)
+        sender.tokens = 0
+        task = asyncio.ensure_future(sender.run())
+        polled = sender.send(poll, PRIORITY_POLL)
+        await asyncio.sleep(0.005)  # the poll now waits for airtime
+        commanded = sender.send(command, PRIORITY_COMMAND)
+        await asyncio.wait_for(asyncio.gather(polled, commanded), 2)
+        task.cancel()
+        return sender.transport.written
+
+    assert asyncio.run(run()) == [command, poll]
+
+
+def test_messages_of_same_priority_keep_their_order():
+    messages = [bytes(SMI260Commands().query_state(address)) for address in ('1', '2', '3')]
+
+    async def run():
+        sender = transmitter(duty_cycle=0.5)
+        sender.tokens = 0
+        task = asyncio.ensure_future(sender.run())
+        futures = [sender.send(message) for message in messages]
+        await asyncio.wait_for(asyncio.gather(*futures), 2)
+        task.cancel()
+        return sender.transport.written
+
+    assert asyncio.run(run()) == messages
@@ -0,0 +1,83 @@
+import pytest
+from wmbus import WMBusFrame, WMBusLayoutCache
+from helpers import STATE, SETTINGS, with_address, with_power
+
+
+def parse(sample, layout_cache=None, lazy=False):
+    frame = WMBusFrame()
+    frame.parse(memoryview(sample), None, layout_cache, lazy)
+    return frame
+
+
+def record_values(frame):
+    return [(bytes(record.header.dif), bytes(record.header.vif), bytes(record.value)) for record in frame.records]
+
+
+@pytest.mark.parametrize('sample', [STATE, SETTINGS])
+def test_cached_parse_equals_plain_parse(sample):
+    cache = WMBusLayoutCache()
+    expected = record_values(parse(sample))
+
+    assert record_values(parse(sample, cache)) == expected
+    assert record_values(parse(sample, cache)) == expected
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cached_layout_slices_new_values():
+    cache = WMBusLayoutCache()
+    parse(STATE, cache)
+    frame = parse(with_power(STATE, 0x0123), cache)
+
+    assert cache.hits == 1
+    assert frame.records[1].get_power_in_w() == 0x0123
+    assert record_values(frame) == record_values(parse(with_power(STATE, 0x0123)))
+
+
+def test_changed_structure_misses_cache():
+    cache = WMBusLayoutCache()
+    parse(STATE, cache)
+    changed = bytearray(STATE)
+    changed[22] = 0x2C  # other VIF of the power record
+    frame = parse(bytes(changed), cache)
+
+    assert (cache.hits, cache.misses) == (0, 2)
+    assert record_values(frame) == record_values(parse(bytes(changed)))
+
+
+def test_cache_evicts_least_recently_used():
+    cache = WMBusLayoutCache(max_size=2)
+    first, second, third = (with_address(STATE, bytes((number, 0, 0))) for number in (1, 2, 3))
+    parse(first, cache)
+    parse(second, cache)
+    parse(first, cache)  # first is now used more recently than second
+    parse(third, cache)
+
+    assert len(cache.layouts) == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+    parse(first, cache)
+    assert cache.hits == 2
+    parse(second, cache)
+    assert cache.misses == 4
+
+
+def test_lazy_state_frames_hit_cache():
+    # the gateway only reads the first two records of state frames
+    cache = WMBusLayoutCache()
+    for power in (100, 200, 300):
+        frame = parse(with_power(STATE, power), cache, lazy=True)
+        assert frame.records[0].get_energy_in_wh() == 0x01E240
+        assert frame.records[1].get_power_in_w() == power
+
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert len(cache.layouts) == 1
+
+
+@pytest.mark.parametrize('sample', [STATE, SETTINGS])
+def test_lazy_parse_equals_plain_parse(sample):
+    expected = record_values(parse(sample))
+    cache = WMBusLayoutCache()
+
+    assert record_values(parse(sample, lazy=True)) == expected
+    assert record_values(parse(sample, cache, lazy=True)) == expected
+    assert record_values(parse(sample, cache, lazy=True)) == expected
+    assert parse(sample, lazy=True).records[-1].value == parse(sample).records[-1].value